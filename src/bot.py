@@ -1,36 +1,69 @@
-from collections import defaultdict
+import csv
+from dataclasses import dataclass
+from io import StringIO
+from tempfile import SpooledTemporaryFile
+from typing import IO, TYPE_CHECKING, AsyncIterator
 
-from telegram import Update
+from telegram import Update, Message
+from telegram.error import BadRequest
 from telegram.ext import ContextTypes
 
+from cache import TTLCache
+from conf import ROSTER_CACHE_TTL
+from logs import custom_logger
+from outbox import outbox, Priority
+
+if TYPE_CHECKING:
+    from db import StudentStats, Lesson
+    from grading import Finals
+
+# gradebook is kept in memory up to that size and spooled to disk beyond it
+GRADEBOOK_SPOOL_SIZE = 1024 * 1024
+
+
+@dataclass
+class LiveSummary:
+    """last text this process rendered into the lesson summary message"""
+    lesson_id: int
+    message_id: int
+    header: str
+    text: str = ''
+
 
 class Bot:
     """Representation Layer"""
 
+    # chat_id -> LiveSummary, only spares edits that would not change the text, other processes edit it as well
+    summaries = TTLCache(maxsize=1024, ttl=ROSTER_CACHE_TTL)
+
+    @classmethod
+    async def send_message(cls, context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str,
+                           priority: Priority = Priority.STUDENT):
+        """
+        sends through the rate-limited outbox instead of calling telegram directly.
+        Message is only queued, so the callback goes on and its next message may be coalesced
+        """
+        outbox.post(context.bot, chat_id, text, priority)
+
     @classmethod
     async def display_attendance(cls, students_info: dict[str, int], update: Update, context: ContextTypes.DEFAULT_TYPE):
         response = '\n'.join(sorted([f'{username} {attendance}' for username, attendance in students_info.items()]))
         if response:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=response)
+            await cls.send_message(context, chat_id=update.effective_chat.id, text=response, priority=Priority.TEACHER)
         else:
             await cls.display_no_students(update, context)
 
     @classmethod
-    async def display_participation(cls, students_info: dict[str, list[bool]], update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def display_participation(cls, students_info: dict[str, int], update: Update, context: ContextTypes.DEFAULT_TYPE):
         stats = []
 
-        for name, info in students_info.items():
-            points = info.count(True) - info.count(False)
-            if points > 0:
-                mark = '+' * points
-            else:
-                mark = '-' * -points
-            stats.append(f'{name}: {mark}')
+        for name, points in students_info.items():
+            stats.append(f'{name}: {cls._participation_mark(points)}')
 
         response = '\n'.join(sorted(stats))
 
         if response:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=response)
+            await cls.send_message(context, chat_id=update.effective_chat.id, text=response, priority=Priority.TEACHER)
         else:
             await cls.display_no_students(update, context)
 
@@ -39,15 +72,158 @@ class Bot:
         stats = []
 
         for name, info in students_info.items():
-            stats.append(f'{name}: {", ".join(map(str, filter(lambda val: val is not None, info)))}')
+            stats.append(f'{name}: {", ".join(map(str, info))}')
 
         response = '\n'.join(sorted(stats))
 
         if response:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=response)
+            await cls.send_message(context, chat_id=update.effective_chat.id, text=response, priority=Priority.TEACHER)
         else:
             await cls.display_no_students(update, context)
 
+    @classmethod
+    async def display_finals(cls, finals: 'Finals', update: Update, context: ContextTypes.DEFAULT_TYPE):
+        from grading import MAX_GRADE
+
+        if not finals.usernames:
+            return await cls.display_no_students(update, context)
+
+        lines = [
+            f'{username}: {coursework:.1f} coursework, {final:.1f} of the final'
+            for username, coursework, final in zip(finals.usernames, finals.coursework, finals.final)
+        ]
+        exam_weight = finals.exam_weight[0]
+        lines.append(f'Exam gives the remaining {exam_weight / 100 * MAX_GRADE:.1f} points ({exam_weight:.0f}%)')
+
+        await cls.send_message(
+            context, chat_id=update.effective_chat.id, text='\n'.join(lines), priority=Priority.TEACHER
+        )
+
+    @classmethod
+    async def display_skipped(cls, skipped: list[str], suggestions: dict[str, str],
+                              update: Update, context: ContextTypes.DEFAULT_TYPE):
+        names = [
+            f'{name} (did you mean {suggestions[name]}?)' if name in suggestions else name
+            for name in skipped
+        ]
+        await cls.send_message(
+            context, chat_id=update.effective_chat.id, text=f'Skipped: {", ".join(names)}', priority=Priority.TEACHER
+        )
+
     @classmethod
     async def display_no_students(cls, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await context.bot.send_message(chat_id=update.effective_chat.id, text='No students present yet')
\ No newline at end of file
+        await cls.send_message(context, chat_id=update.effective_chat.id, text='No students present yet')
+
+    @staticmethod
+    def lesson_header(title: str) -> str:
+        return f'Started lesson {title}'
+
+    @classmethod
+    async def send_lesson_header(cls, context: ContextTypes.DEFAULT_TYPE, chat_id: int, title: str) -> Message:
+        """waits for delivery, header is never coalesced since live summary edits replace the whole message"""
+        return await outbox.send(context.bot, chat_id, cls.lesson_header(title), Priority.TEACHER, coalesce=False)
+
+    @classmethod
+    def start_summary(cls, chat_id: int, lesson_id: int, message_id: int, title: str):
+        header = cls.lesson_header(title)
+        cls.summaries.set(chat_id, LiveSummary(lesson_id, message_id, header, text=header))
+
+    @classmethod
+    def get_summary(cls, chat_id: int, lesson_id: int, message_id: int) -> LiveSummary | None:
+        """cached summary if it is still rendered for the same lesson message"""
+        summary = cls.summaries.get(chat_id)
+        if summary and summary.lesson_id == lesson_id and summary.message_id == message_id:
+            return summary
+
+        return None
+
+    @classmethod
+    async def display_summary(cls, summary: LiveSummary, students_info: dict[str, 'StudentStats'],
+                              update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        """
+        renders summary of all given students and edits summary message in place,
+        unchanged summary costs no API calls.
+        :return: False if message could not be edited
+        """
+        chat_id = update.effective_chat.id
+
+        lines = [
+            ' '.join(filter(None, (
+                name,
+                f'{stats.attendance_count}',
+                cls._participation_mark(stats.participation_balance),
+                ', '.join(map(str, stats.grades)),
+            )))
+            for name, stats in students_info.items()
+        ]
+        text = '\n'.join((summary.header, *sorted(lines)))
+
+        if text != summary.text:
+            try:
+                await outbox.edit(context.bot, chat_id, summary.message_id, text)
+            except BadRequest as e:
+                # message may already hold the same text rendered by another process
+                if 'not modified' not in e.message:
+                    cls.summaries.pop(chat_id)
+                    custom_logger.warning('%s: summary not edited %s', chat_id, e.message)
+                    return False
+
+            summary.text = text
+
+        cls.summaries.set(chat_id, summary)
+        return True
+
+    @classmethod
+    async def render_gradebook(cls, lessons: list['Lesson'], rows: AsyncIterator[tuple]) -> SpooledTemporaryFile:
+        """
+        writes csv with a row per student and a column per lesson while rows are streamed,
+        cell holds v for presence or a grade, followed by + or - for participation, absence leaves it empty
+        :return: file rewound for sending, to be closed by the caller
+        """
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        file = SpooledTemporaryFile(max_size=GRADEBOOK_SPOOL_SIZE)
+
+        try:
+            writer.writerow((
+                'username', 'name', *(f'{lesson.date} {lesson.title}' for lesson in lessons), 'attended', 'participation'
+            ))
+
+            async for username, name, presence, grades, participation in rows:
+                writer.writerow((
+                    username,
+                    name,
+                    *map(cls._gradebook_cell, presence, grades, participation),
+                    sum(presence),
+                    sum(1 if mark else -1 for mark in participation if mark is not None),
+                ))
+                file.write(buffer.getvalue().encode())
+                buffer.seek(0)
+                buffer.truncate()
+
+            file.write(buffer.getvalue().encode())
+            file.seek(0)
+        except BaseException:
+            file.close()
+            raise
+
+        return file
+
+    @classmethod
+    async def send_gradebook(cls, file: IO[bytes], filename: str,
+                             update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await outbox.send_document(context.bot, update.effective_chat.id, file, filename)
+
+    @staticmethod
+    def _gradebook_cell(present: bool, grade: int | None, participation: bool | None) -> str:
+        if not present:
+            return ''
+
+        mark = '' if participation is None else ('+' if participation else '-')
+        return f'{"v" if grade is None else grade}{mark}'
+
+    @staticmethod
+    def _participation_mark(points: int) -> str:
+        if points > 0:
+            return '+' * points
+        return '-' * -points
@@ -0,0 +1,54 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Callable, Hashable
+
+
+class TTLCache:
+    """Bounded in-process LRU mapping with optional expiration of entries"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float | None, Any]] = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            expires_at, value = self._data[key]
+        except KeyError:
+            return default
+
+        if expires_at is not None and expires_at < monotonic():
+            del self._data[key]
+            return default
+
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        expires_at = monotonic() + self.ttl if self.ttl is not None else None
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        _, value = self._data.pop(key, (None, default))
+        return value
+
+    def discard_where(self, predicate: Callable[[Hashable], bool]):
+        """drops every entry whose key satisfies predicate"""
+        for key in [key for key in self._data if predicate(key)]:
+            del self._data[key]
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+_MISSING = object()
@@ -1,15 +1,21 @@
-from datetime import date
+from datetime import date, datetime, timedelta, timezone
 from functools import partial
 from random import randint
+from typing import TYPE_CHECKING
 
 from telegram import Update
+from telegram.error import TelegramError
 from telegram.ext import ContextTypes, CallbackContext
 
-from bot import Bot
-from data import DataStorage, UserInfo, PARTICIPATION_TYPES
-from decorators import teacher_only
+from bot import Bot, LiveSummary
+from decorators import teacher_only, unit_of_work
 from exceptions import NotFoundError,LogicError
 from logs import custom_logger
+from outbox import Priority
+
+if TYPE_CHECKING:
+    # data layer is imported by unit_of_work on first use, so that updates not touching database don't load it
+    from data import DataStorage
 
 
 async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -41,55 +47,71 @@ Timer set for 5 minutes
 Times up!
 
 /lesson title -- begins a lesson
+
+/stats -- sends the gradebook of the course as a csv file
+
+/final -- final grades earned so far, the rest is left for the exam
 """
 
-    # TODO: /stats /add_teacher
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=help_text)
+    # TODO: /add_teacher
+    await Bot.send_message(context, chat_id=update.effective_chat.id, text=help_text)
 
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@unit_of_work
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE, ds: 'DataStorage'):
     chat = update.effective_chat
     chat_title = chat.title
     chat_id = chat.id
 
     if not chat_title:
-        return await update.message.reply_text('This chat does not have a title.')
+        return await Bot.send_message(
+            context, chat_id=chat_id, text='This chat does not have a title.', priority=Priority.TEACHER
+        )
 
     # TODO: many groups in one chat
     group_title, _, course_title = chat_title.partition(' ')
 
     if not (group_title and course_title):
-        return await update.message.reply_text('Wrong chat title! Should follow the pattern <group> <course>.')
+        return await Bot.send_message(
+            context, chat_id=chat_id, text='Wrong chat title! Should follow the pattern <group> <course>.',
+            priority=Priority.TEACHER
+        )
+
+    from data import UserInfo
 
     tg_user = update.effective_user
     user_info = UserInfo(f'{tg_user.id}', tg_user.username, tg_user.full_name)
 
-    ds = DataStorage(chat_id)
-
     exists, course_info = await ds.get_or_create_course(
         user_info=user_info, title=course_title, group=group_title
     )
 
     if exists:
+        # committed before the bot api round trip, see unit_of_work
+        await ds.commit()
         invite_link = await context.bot.export_chat_invite_link(chat_id)
-        return await update.message.reply_text(
-            text=f'Course already exists: {invite_link}'
+        return await Bot.send_message(
+            context, chat_id=chat_id, text=f'Course already exists: {invite_link}', priority=Priority.TEACHER
         )
 
     course = course_info.course
     teacher = course_info.teachers[0]
 
-    await update.message.reply_text(
-        'Chat created successfully.\n'
-        f'Course: {course.title}\n'
-        f'Year: {course.year}\n'
-        f'Group: {course.group}\n'
-        f'Teacher: {teacher.name}'
+    await Bot.send_message(
+        context,
+        chat_id=chat_id,
+        text='Chat created successfully.\n'
+             f'Course: {course.title}\n'
+             f'Year: {course.year}\n'
+             f'Group: {course.group}\n'
+             f'Teacher: {teacher.name}',
+        priority=Priority.TEACHER
     )
 
 
 async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await context.bot.send_message(
+    await Bot.send_message(
+        context,
         chat_id=update.effective_chat.id,
         text='Bot cannot be stopped 👹\n'
              'Kick it from the chat.'
@@ -98,100 +120,105 @@ async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if msg := update.effective_message.text:
-        custom_logger.warning(msg)
-    await context.bot.send_message(chat_id=update.effective_chat.id, text="I didn't understand that command")
+        # constant message, so that a flood of different commands is rate limited as one warning
+        custom_logger.warning('%s: unknown command %s', update.effective_chat.id, msg)
+    await Bot.send_message(context, chat_id=update.effective_chat.id, text="I didn't understand that command")
 
 
-async def randomize(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
-    ds = DataStorage(chat_id)
-
-    all_presented = await ds.get_presented()
-    if not all_presented:
+@unit_of_work
+async def randomize(update: Update, context: ContextTypes.DEFAULT_TYPE, ds: 'DataStorage'):
+    candidates = await ds.get_lesson_candidates()
+    if not candidates:
         await Bot.display_no_students(update, context)
         return
-        
-    performance_grades = await ds.get_performance(fetch_grades=True)
-    performance_participation = await ds.get_performance(fetch_grades=False)
-    
-    graded_students = set()
-    for username, grades in performance_grades.items():
-        if grades and grades[-1] is not None:  
-            graded_students.add(username)
-            
-    for username, participations in performance_participation.items():
-        if participations and participations[-1] is not None:  
-            graded_students.add(username)
-    
-    eligible_students = [student for student in all_presented if student not in graded_students]
-    
+
+    eligible_students = [username for username, eligible in candidates.items() if eligible]
+
     if not eligible_students:
-        await context.bot.send_message(
+        await Bot.send_message(
+            context,
             chat_id=update.effective_chat.id,
             text="All present students already have grades for this lesson."
         )
     else:
         chosen_student = eligible_students[randint(0, len(eligible_students) - 1)]
-        await context.bot.send_message(
+        await Bot.send_message(
+            context,
             chat_id=update.effective_chat.id,
             text=f"I've chosen {chosen_student}"
         )
 
 
+@unit_of_work
 @teacher_only
-async def ignore(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def ignore(update: Update, context: ContextTypes.DEFAULT_TYPE, ds: 'DataStorage'):
     chat_id = update.effective_chat.id
     if len(candidates := context.args) != 1:
-        return await context.bot.send_message(chat_id=chat_id, text='Please specify one student')
+        return await Bot.send_message(
+            context, chat_id=chat_id, text='Please specify one student', priority=Priority.TEACHER
+        )
+    candidate = candidates[0].lstrip('@')
+    resolution = await ds.resolve_names({candidate})
+
     try:
-        ds = DataStorage(chat_id)
-        await ds.remove_student(candidates[0].lstrip('@'))
+        # student is removed only if named exactly or up to case, a similar name is merely suggested
+        await ds.remove_student(resolution.usernames.get(candidate, candidate))
 
     except NotFoundError as e:
         msg = f'{chat_id}: {e.__doc__}'
         custom_logger.warning(msg)
-        return await context.bot.send_message(
-            chat_id=chat_id, text=f'{e.__doc__}'
+        suggestion = resolution.suggestions.get(candidate)
+        return await Bot.send_message(
+            context, chat_id=chat_id, text=f'{e.__doc__}' + (f', did you mean {suggestion}?' if suggestion else ''),
+            priority=Priority.TEACHER
         )
 
     except LogicError as e:
         msg = f'{chat_id}: {e.args[0]}'
         custom_logger.warning(msg)
-        return await context.bot.send_message(chat_id=chat_id, text=e.args[0])
+        return await Bot.send_message(context, chat_id=chat_id, text=e.args[0], priority=Priority.TEACHER)
 
-    await context.bot.send_message(chat_id=chat_id,
-                                   text=f'Specified user is no longer considered a student. '
-                                        f'/register to make them student again')
+    await Bot.send_message(context, chat_id=chat_id,
+                           text=f'Specified user is no longer considered a student. '
+                                f'/register to make them student again',
+                           priority=Priority.TEACHER)
 
 
+@unit_of_work
 @teacher_only
-async def present(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def present(update: Update, context: ContextTypes.DEFAULT_TYPE, ds: 'DataStorage'):
     chat_id = update.effective_chat.id
     candidates = {candidate.lstrip('@') for candidate in context.args}  # removing @ from username
 
     if not candidates:
-        return await context.bot.send_message(chat_id=chat_id, text='Please specify present students')
+        return await Bot.send_message(
+            context, chat_id=chat_id, text='Please specify present students', priority=Priority.TEACHER
+        )
+
+    resolution = await ds.resolve_names(candidates)
 
-    ds = DataStorage(chat_id)
     try:
-        skipped = await ds.mark_present(candidates)
+        skipped = resolution.skipped + await ds.mark_present(resolution.resolved)
         if skipped:
-            await context.bot.send_message(
-                chat_id=chat_id, text=f'Skipped: {", ".join(skipped)}'
-            )
+            await Bot.display_skipped(skipped, resolution.suggestions, update, context)
     except NotFoundError as e:
         msg = f'{chat_id}: {e.__doc__}'
         custom_logger.warning(msg)
-        return await context.bot.send_message(
-            chat_id=chat_id, text='Lesson should be started before checking attendance. Press /lesson'
+        return await Bot.send_message(
+            context, chat_id=chat_id, text='Lesson should be started before checking attendance. Press /lesson',
+            priority=Priority.TEACHER
         )
 
-    attendances = await ds.get_attendance()
-    await Bot.display_attendance(attendances, update, context)
+    if not await refresh_summary(update, context, ds):
+        attendances = await ds.get_attendance()
+        await Bot.display_attendance(attendances, update, context)
 
 
+@unit_of_work
 @teacher_only
-async def grade(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def grade(update: Update, context: ContextTypes.DEFAULT_TYPE, ds: 'DataStorage'):
+    from data import PARTICIPATION_TYPES
+
     chat_id = update.effective_chat.id
 
     common_marks = {'0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '10'}
@@ -199,10 +226,11 @@ async def grade(update: Update, context: ContextTypes.DEFAULT_TYPE):
     allowed_marks = common_marks | bonus_marks
 
     candidates = {candidate.lstrip('@') for candidate in context.args[1:]}
-    ds = DataStorage(chat_id)
 
     if len(context.args) < 1 or ((mark := context.args[0]) not in allowed_marks):
-        return await context.bot.send_message(chat_id=update.effective_chat.id, text='Grade not specified')
+        return await Bot.send_message(
+            context, chat_id=update.effective_chat.id, text='Grade not specified', priority=Priority.TEACHER
+        )
 
     display_func = Bot.display_participation
     get_performance = ds.get_performance
@@ -212,30 +240,56 @@ async def grade(update: Update, context: ContextTypes.DEFAULT_TYPE):
         display_func = Bot.display_grades
         get_performance = partial(get_performance, fetch_grades=True)
 
+    resolution = await ds.resolve_names(candidates)
+
     try:
-        skipped = await ds.grade_students(candidates, mark)
+        skipped = resolution.skipped + await ds.grade_students(resolution.resolved, mark)
     except NotFoundError as e:
         msg = f'{chat_id}: {e.__doc__}'
         custom_logger.warning(msg)
-        return await context.bot.send_message(
-            chat_id=chat_id, text='Lesson should be started before grading students. Press /lesson'
+        return await Bot.send_message(
+            context, chat_id=chat_id, text='Lesson should be started before grading students. Press /lesson',
+            priority=Priority.TEACHER
         )
 
     if skipped:
-        await context.bot.send_message(
-            chat_id=chat_id, text=f'Skipped: {", ".join(skipped)}'
-        )
+        await Bot.display_skipped(skipped, resolution.suggestions, update, context)
+
+    if not await refresh_summary(update, context, ds):
+        performance_by_student = await get_performance()
+        await display_func(performance_by_student, update, context)
 
-    performance_by_student = await get_performance()
-    await display_func(performance_by_student, update, context)
 
+async def refresh_summary(update: Update, context: ContextTypes.DEFAULT_TYPE, ds: 'DataStorage') -> bool:
+    """
+    edits live summary of the current lesson instead of sending the whole roster.
+    Summary is rendered from stats of all students present at the lesson every time,
+    so students added by another process to the same message are never written over
+    :return: False if lesson has no live summary
+    """
+    chat_id = update.effective_chat.id
+    lesson = await ds.get_current_lesson()
+
+    if lesson is None or lesson.summary_message_id is None:
+        return False
+
+    summary = (
+        Bot.get_summary(chat_id, lesson.id, lesson.summary_message_id)
+        or LiveSummary(lesson.id, lesson.summary_message_id, Bot.lesson_header(lesson.title))
+    )
+    students_info = await ds.get_stats()
+
+    return await Bot.display_summary(summary, students_info, update, context)
+
+
+@unit_of_work
+async def register(update: Update, context: ContextTypes.DEFAULT_TYPE, ds: 'DataStorage'):
+    from data import UserInfo
 
-async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     tg_user = update.effective_user
     user_id = f'{tg_user.id}'
 
-    ds = DataStorage(chat_id)
     user_info = UserInfo(user_id, tg_user.username, tg_user.full_name)
 
     try:
@@ -243,44 +297,73 @@ async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except LogicError as e:
         msg = f'{chat_id}: {e.args[0]}'
         custom_logger.warning(msg)
-        return await context.bot.send_message(chat_id=chat_id, text=e.args[0])
+        return await Bot.send_message(context, chat_id=chat_id, text=e.args[0])
     except NotFoundError as e:
         msg = f'{chat_id}: {e.__doc__}'
         custom_logger.warning(msg)
-        return await context.bot.send_message(chat_id=chat_id, text='Teacher should start the bot first')
+        return await Bot.send_message(context, chat_id=chat_id, text='Teacher should start the bot first')
 
-    await context.bot.send_message(
-        chat_id=chat_id, text=f'student {tg_user.full_name or tg_user.username} registered'
+    await Bot.send_message(
+        context, chat_id=chat_id, text=f'student {tg_user.full_name or tg_user.username} registered'
     )
 
 
-async def timer(update: Update, context: CallbackContext):
+@unit_of_work
+async def timer(update: Update, context: CallbackContext, ds: 'DataStorage'):
     """
-    NB: Timer won't work in serverless environment in a cloud function. Because of short life span of such function.
-    After invocation function processes updates and quits, Long-running tasks will not persist.
-
-    TODO: use jobs queues provided by cloud service.
-    For example, Timer can be implemented using triggers in yc:
-    https://yandex.cloud/en/docs/functions/operations/trigger/timer-create
+    Timer is stored in the database and delivered by the scheduler,
+    so it survives restarts and short-lived serverless invocations
     """
-    async def timer_callback(_context: CallbackContext):
-        await _context.bot.send_message(chat_id=_context.job.chat_id, text="Time's up!")
-
-    minutes = 0
     max_minutes = 1440
-    if context.args and context.args[0].isdigit() and minutes <= max_minutes:
-        minutes = int(context.args[0])
-    await update.message.reply_text(f'Timer started for {minutes} minutes.')
+    if not (context.args and context.args[0].isdigit() and 0 < (minutes := int(context.args[0])) <= max_minutes):
+        return await Bot.send_message(
+            context, chat_id=update.effective_chat.id, text=f'Please specify from 1 to {max_minutes} minutes.'
+        )
 
-    context.job_queue.run_once(timer_callback, minutes * 60, chat_id=update.message.chat_id)
+    await ds.add_timer(datetime.now(timezone.utc) + timedelta(minutes=minutes), "Time's up!")
+    await Bot.send_message(context, chat_id=update.effective_chat.id, text=f'Timer started for {minutes} minutes.')
 
 
+@unit_of_work
 @teacher_only
-async def lesson(update: Update, context: CallbackContext):
+async def lesson(update: Update, context: CallbackContext, ds: 'DataStorage'):
     chat_id = update.effective_chat.id
     title = ' '.join(context.args)
-    ds = DataStorage(chat_id)
     await ds.start_lesson(title, date.today())
+    # lesson is committed before bot api calls, so a failed call does not roll it back after it was announced
+    # and the course row is not locked while the message waits for the rate limit
+    await ds.commit()
+
+    message = await Bot.send_lesson_header(context, chat_id, title)
+    try:
+        await context.bot.pin_chat_message(chat_id=chat_id, message_id=message.message_id)
+    except TelegramError as e:
+        # e.g. bot has no right to pin messages, summary is edited all the same
+        custom_logger.warning('%s: summary not pinned %s', chat_id, e.message)
+
+    # pinned message is edited with live summary of the lesson
+    await ds.set_summary_message(message.message_id)
+    Bot.start_summary(chat_id, ds.current_lesson_id, message.message_id, title)
+
+
+@unit_of_work
+@teacher_only
+async def stats(update: Update, context: CallbackContext, ds: 'DataStorage'):
+    # header and rows are read from one snapshot, a lesson started in between would shift columns against the header
+    await ds.snapshot()
+    course = (await ds.get_course()).course
+    lessons = await ds.get_lessons()
+
+    with await Bot.render_gradebook(lessons, ds.stream_gradebook()) as file:
+        # committed before the upload waits for the rate limit, see unit_of_work
+        await ds.commit()
+        await Bot.send_gradebook(file, f'{course.group} {course.title} {date.today()}.csv', update, context)
+
+
+@unit_of_work
+@teacher_only
+async def final(update: Update, context: CallbackContext, ds: 'DataStorage'):
+    from grading import compute_finals
 
-    message = await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Started lesson {title}')
-    await context.bot.pin_chat_message(chat_id=chat_id, message_id=message.message_id)
\ No newline at end of file
+    finals = compute_finals(await ds.get_final_inputs())
+    await Bot.display_finals(finals, update, context)
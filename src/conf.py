@@ -1,9 +1,57 @@
 from os import environ
 
 BOT_TOKEN = environ.get('BOT_TOKEN')
+# bot api server, telegram's one unless set, e.g. to a local fake for benchmarks
+BOT_API_URL = environ.get('BOT_API_URL')
 
 DB_USER = environ.get('DB_USER', 'bot')
 DB_PASS = environ.get('DB_PASS', 'bot')
 DB_HOST = environ.get('DB_HOST', 'localhost')
 DB_PORT = environ.get('DB_PORT', '5432')
-DB_NAME = environ.get('DB_NAME', 'bot')
\ No newline at end of file
+DB_NAME = environ.get('DB_NAME', 'bot')
+
+ROSTER_CACHE_TTL = float(environ.get('ROSTER_CACHE_TTL', '60'))
+
+WARM_START = environ.get('WARM_START', '1') == '1'
+
+# Telegram allows about 30 messages per second overall and 20 messages per minute to the same group
+OUTBOX_GLOBAL_RATE = float(environ.get('OUTBOX_GLOBAL_RATE', '30'))
+OUTBOX_CHAT_RATE = int(environ.get('OUTBOX_CHAT_RATE', '20'))
+
+# polling or webhook, how main.py receives updates in a long-running process
+RUN_MODE = environ.get('RUN_MODE', 'polling')
+WEBHOOK_URL = environ.get('WEBHOOK_URL')
+WEBHOOK_LISTEN = environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(environ.get('WEBHOOK_PORT', '8443'))
+WEBHOOK_SECRET = environ.get('WEBHOOK_SECRET')
+
+# updates handled at once by a long-running process and updates allowed to wait for a slot, the rest are dropped
+MAX_CONCURRENT_UPDATES = int(environ.get('MAX_CONCURRENT_UPDATES', '16'))
+MAX_UPDATE_BACKLOG = int(environ.get('MAX_UPDATE_BACKLOG', '256'))
+
+# timers claimed by the scheduler per transaction and seconds between its runs in a long-running process
+TIMER_BATCH_SIZE = int(environ.get('TIMER_BATCH_SIZE', '500'))
+TIMER_INTERVAL = float(environ.get('TIMER_INTERVAL', '10'))
+
+# queue keeps connections of a long-running process, null connects per session for serverless containers
+DB_POOL = environ.get('DB_POOL', 'queue')
+DB_POOL_SIZE = int(environ.get('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(environ.get('DB_MAX_OVERFLOW', '11'))
+DB_POOL_TIMEOUT = float(environ.get('DB_POOL_TIMEOUT', '30'))
+DB_POOL_RECYCLE = int(environ.get('DB_POOL_RECYCLE', '1800'))
+DB_PRE_PING = environ.get('DB_PRE_PING', '0') == '1'
+# pgbouncer in transaction mode does not keep prepared statements between transactions
+DB_PGBOUNCER = environ.get('DB_PGBOUNCER', '0') == '1'
+
+# share of updates whose trace is logged, updates slower than TRACE_SLOW_MS are always logged
+TRACE_SAMPLE_RATE = float(environ.get('TRACE_SAMPLE_RATE', '0.1'))
+TRACE_SLOW_MS = float(environ.get('TRACE_SLOW_MS', '1000'))
+
+LOG_LEVEL = environ.get('LOG_LEVEL', 'DEBUG').upper()
+# warnings with the same message in the same chat let through per window of seconds, the rest are dropped
+LOG_WARNING_BURST = int(environ.get('LOG_WARNING_BURST', '5'))
+LOG_WARNING_WINDOW = float(environ.get('LOG_WARNING_WINDOW', '60'))
+
+# update ids remembered by a warm container and seconds they are kept there and in the database to acknowledge redeliveries
+DEDUP_CACHE_SIZE = int(environ.get('DEDUP_CACHE_SIZE', '10000'))
+DEDUP_TTL = int(environ.get('DEDUP_TTL', '86400'))
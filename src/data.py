@@ -1,12 +1,23 @@
-from collections import defaultdict
-from dataclasses import dataclass
-from datetime import date
-
-from sqlalchemy import select, func
-
-from db import User, Course, ASession, UserCourseAssociation, Lesson, Attendance
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from typing import AsyncIterator
+
+from sqlalchemy import select, update, delete, func, and_, case, literal, literal_column
+from sqlalchemy.dialects.postgresql import insert, aggregate_order_by
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+
+from cache import TTLCache
+from conf import ROSTER_CACHE_TTL
+from db import (
+    User, Course, ASession, UserCourseAssociation, Lesson, Attendance, StudentStats, Timer, ProcessedUpdate
+)
 from exceptions import LogicError, CourseNotFoundError, StudentNotFoundError, LessonNotFoundError
 from logs import custom_logger
+from names import NameIndex, Resolution
+from tracing import trace_methods
 
 
 LESSON_TYPES = {
@@ -34,28 +45,109 @@ class CourseInfo:
     students: list[User]
     teachers: list[User]
     course: Course
+    # built on first lookup, cached and invalidated together with the roster
+    names: NameIndex | None = field(default=None, repr=False)
+
+
+# rows fetched from the server-side cursor at once while exporting a gradebook
+GRADEBOOK_BATCH_SIZE = 100
+
+# chat_id -> CourseInfo, shared by all DataStorage instances of the process
+rosters = TTLCache(maxsize=1024, ttl=ROSTER_CACHE_TTL)
+# (chat_id, tg_user_id) -> is teacher, roles only change when a course is created
+roles = TTLCache(maxsize=4096)
 
 
+@trace_methods
 class DataStorage:
     """
     Data Access Layer
-    NB: protected methods don't open session so that they could be used within one session
+    NB: protected methods don't open session so that they could be used within one session.
+    When constructed with a session (unit of work) public methods share it and changes are persisted by commit()
     """
 
-    def __init__(self, chat_id: int):
+    def __init__(self, chat_id: int, session: AsyncSession | None = None):
         self.chat_id: str = f'{chat_id}'
+        self.session = session
+        self.course_info: CourseInfo | None = None
+        # roster was read from the database by this instance and not taken from the shared cache
+        self.roster_loaded = False
+        # process-wide caches are dropped only after the change is committed
+        self.roster_changed = False
+        self.roles_changed = False
         self.course_related_subquery = (
                 select(UserCourseAssociation.user_id)
                 .join(Course, Course.id == UserCourseAssociation.course_id)
                 .where(Course.chat_id == self.chat_id)
                 .subquery()
             )
+        self.course_id_subquery = (
+            select(Course.id).where(Course.chat_id == self.chat_id)
+        ).scalar_subquery()
+        self.current_lesson_subquery = (
+            select(Course.current_lesson_id).where(Course.chat_id == self.chat_id)
+        ).scalar_subquery()
+        self.current_lesson_id: int | None = None
+
+    @asynccontextmanager
+    async def _transaction(self) -> AsyncIterator[AsyncSession]:
+        """session of the unit of work if there is one, otherwise a standalone session committed on exit"""
+        if self.session is not None:
+            yield self.session
+        else:
+            async with ASession() as session:
+                yield session
+                await session.commit()
+                self._flush_caches()
+
+    async def commit(self):
+        """commits the unit of work"""
+        await self.session.commit()
+        self._flush_caches()
+
+    async def snapshot(self):
+        """
+        commits the unit of work and continues it in a REPEATABLE READ transaction,
+        so that several reads see the same data
+        """
+        await self.commit()
+        await self.session.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+
+    async def claim_update(self, update_id: int) -> bool:
+        """
+        Records update as processed in the unit of work, so the claim is rolled back if processing fails.
+        Concurrent redelivery waits on the primary key until the first one commits or rolls back
+        :return: False if the update was processed already
+        """
+        async with self._transaction() as session:
+            result = await session.execute(
+                insert(ProcessedUpdate)
+                .values(update_id=update_id)
+                .on_conflict_do_nothing(index_elements=[ProcessedUpdate.update_id])
+                .returning(ProcessedUpdate.update_id)
+            )
+
+            return result.scalar() is not None
+
+    async def _get_course(self, session: AsyncSession, loud: bool = False) -> CourseInfo | None:
+        """
+        Course with its roster loaded in a single query.
+        NB: result is cached per chat, so returned ORM objects may be detached and must be treated as read-only
+        """
+        if self.course_info:
+            return self.course_info
+
+        # roster changed by this instance is not committed yet, so the shared cache is stale for it
+        if not self.roster_changed and (course_info := rosters.get(self.chat_id)):
+            self.course_info = course_info
+            return course_info
 
-    async def _get_course(self, session: ASession, loud: bool = False) -> CourseInfo | None:
         result = await session.execute(
-            select(Course).where(Course.chat_id == self.chat_id)
+            select(Course)
+            .options(joinedload(Course.users).joinedload(UserCourseAssociation.user))
+            .where(Course.chat_id == self.chat_id)
         )
-        course = result.scalars().first()
+        course = result.unique().scalars().first()
 
         if not course:
             if loud:
@@ -63,28 +155,43 @@ class DataStorage:
 
             return None
 
-        stmt = select(UserCourseAssociation).where(UserCourseAssociation.course_id == course.id)
-        result = await session.execute(stmt)
-
         students = []
         teachers = []
 
-        for association in result.scalars().all():
+        for association in course.users:
             if association.teacher:
-                teachers.append(await association.awaitable_attrs.user)
+                teachers.append(association.user)
             else:
-                students.append(await association.awaitable_attrs.user)
+                students.append(association.user)
+
+        self.course_info = CourseInfo(students, teachers, course)
+        self.roster_loaded = True
+        if not self.roster_changed:
+            rosters.set(self.chat_id, self.course_info)
+
+        return self.course_info
+
+    def _invalidate_course(self, roles_changed: bool = False):
+        self.course_info = None
+        self.roster_changed = True
+        self.roles_changed |= roles_changed
 
-        return CourseInfo(students, teachers, course)
+    def _flush_caches(self):
+        if self.roster_changed:
+            rosters.pop(self.chat_id)
+        if self.roles_changed:
+            roles.discard_where(lambda key: key[0] == self.chat_id)
+
+        self.roster_changed = self.roles_changed = False
 
     async def get_course(self) -> CourseInfo | None:
-        async with ASession() as session:
+        async with self._transaction() as session:
             return await self._get_course(session)
 
     async def get_or_create_course(self, user_info: UserInfo, title: str, group: str) -> tuple[bool, CourseInfo]:
         """:return: pair where first element is True if course exists, else False"""
 
-        async with ASession() as session:
+        async with self._transaction() as session:
             course_info = await self._get_course(session)
             exists = course_info is not None
 
@@ -115,13 +222,13 @@ class DataStorage:
                 course.users.append(assoc)
 
                 session.add_all((course, teacher, assoc))
-                await session.commit()
+                self._invalidate_course(roles_changed=True)
 
                 course_info = CourseInfo(students=[], teachers=[teacher], course=course)
 
             return exists, course_info
 
-    async def _get_user(self, session: ASession, tg_id: str, loud: bool = False) -> User | None:
+    async def _get_user(self, session: AsyncSession, tg_id: str, loud: bool = False) -> User | None:
         result = await session.execute(
             select(User).where(User.tg_id == tg_id)
         )
@@ -132,17 +239,21 @@ class DataStorage:
 
         return student
 
-    async def _bind_student_with_course(self, session: ASession, student: User, course: Course):
+    async def _bind_student_with_course(self, session: AsyncSession, student: User, course: Course):
         # link the user and the course, indicating that the user is a student
-        assoc = UserCourseAssociation(teacher=False)
-        assoc.user = student
-
-        (await course.awaitable_attrs.users).append(assoc)
-
-        session.add_all((course, student, assoc))
+        # course may come from the roster cache, so it is referenced by id and not attached to the session.
+        # Cached roster may be stale, so an existing link is left to the primary key and kept as is
+        session.add(student)
+        await session.flush()
+
+        await session.execute(
+            insert(UserCourseAssociation)
+            .values(user_id=student.id, course_id=course.id, teacher=False)
+            .on_conflict_do_nothing(index_elements=[UserCourseAssociation.user_id, UserCourseAssociation.course_id])
+        )
 
     async def add_student(self, user_info: UserInfo):
-        async with ASession() as session:
+        async with self._transaction() as session:
             course_info = await self._get_course(session)
 
             if not course_info:
@@ -150,7 +261,6 @@ class DataStorage:
 
             student = await self._get_user(session, user_info.id)
 
-            students_tg_ids = {st.tg_id for st in course_info.students}
             teachers_tg_ids = {teacher.tg_id for teacher in course_info.teachers}
 
             if not student:
@@ -170,22 +280,66 @@ class DataStorage:
                 student.username = user_info.username
                 student.name = user_info.full_name
 
-            if student.tg_id not in students_tg_ids:
-                await self._bind_student_with_course(session, student, course_info.course)
-
-            session.add(student)
-            await session.commit()
+            await self._bind_student_with_course(session, student, course_info.course)
+            self._invalidate_course()
 
     async def check_is_teacher(self, tg_user_id: str) -> bool:
-        async with ASession() as session:
+        if (is_teacher := roles.get((self.chat_id, tg_user_id))) is not None:
+            return is_teacher
+
+        async with self._transaction() as session:
             course_info = await self._get_course(session, loud=True)
 
             teachers_tg_ids = {t.tg_id for t in course_info.teachers}
 
-            return tg_user_id in teachers_tg_ids
+            is_teacher = tg_user_id in teachers_tg_ids
+            roles.set((self.chat_id, tg_user_id), is_teacher)
+
+            return is_teacher
+
+    async def resolve_names(self, candidates: set[str]) -> Resolution:
+        """
+        maps candidates to usernames of course students tolerating case, suggests similar students for the rest.
+        Roster cached by the process may miss students registered through another one,
+        so it is reloaded once if a candidate is not found in it
+        """
+        async with self._transaction() as session:
+            course_info = await self._get_course(session, loud=True)
+            resolution = self._names(course_info).resolve(candidates)
+
+            if resolution.skipped and not self.roster_loaded:
+                rosters.pop(self.chat_id)
+                self.course_info = None
+                course_info = await self._get_course(session, loud=True)
+                resolution = self._names(course_info).resolve(candidates)
+
+        return resolution
+
+    @staticmethod
+    def _names(course_info: CourseInfo) -> NameIndex:
+        if course_info.names is None:
+            course_info.names = NameIndex(course_info.students)
+
+        return course_info.names
+
+    async def _get_current_lesson_id(self, session: AsyncSession) -> int:
+        """
+        NB: read from the course row and not from the cached roster,
+        so that a lesson started in another process is picked up immediately
+        """
+        if self.current_lesson_id is None:
+            result = await session.execute(
+                select(Course.current_lesson_id).where(Course.chat_id == self.chat_id)
+            )
+            self.current_lesson_id = result.scalar()
+
+        if self.current_lesson_id is None:
+            raise LessonNotFoundError()
+
+        return self.current_lesson_id
 
     async def start_lesson(self, title: str, dt: date):
-        async with ASession() as session:
+        async with self._transaction() as session:
             course_info = await self._get_course(session, loud=True)
             lesson = Lesson(
                 title=title,
@@ -195,133 +349,265 @@ class DataStorage:
             )
 
             session.add(lesson)
-            await session.commit()
-
-    async def mark_present(self, candidates: set[str]) -> list[str]:
-        """marks students as present and returns skipped candidates"""
-        async with ASession() as session:
-            course_info = await self._get_course(session, loud=True)
-
-            course = course_info.course
-
-            if not await course.awaitable_attrs.lessons:
-                raise LessonNotFoundError()
+            await session.flush()
 
-            presented = set(await self._get_presented(session))
-            by_usernames = {st.username: st for st in course_info.students}
-            skipped: list[str] = []
-            attendances: list[Attendance] = []
+            await session.execute(
+                update(Course).where(Course.id == lesson.course_id).values(current_lesson_id=lesson.id)
+            )
+            self.current_lesson_id = lesson.id
 
-            for candidate in candidates:
-                if (student := by_usernames.get(candidate)) and candidate not in presented:
-                    attendances.append(Attendance(
-                        user_id=student.id,
-                        lesson_id=course.lessons[-1].id
-                    ))
-                else:
-                    skipped.append(candidate)
+    async def get_current_lesson(self) -> Lesson | None:
+        async with self._transaction() as session:
+            result = await session.execute(
+                select(Lesson).where(Lesson.id == self.current_lesson_subquery)
+            )
 
-            session.add_all(attendances)
-            await session.commit()
+            return result.scalars().first()
 
-            return skipped
+    async def set_summary_message(self, message_id: int):
+        """remembers message of the current lesson to be edited with live summary"""
+        async with self._transaction() as session:
+            await session.execute(
+                update(Lesson).where(Lesson.id == self.current_lesson_subquery).values(summary_message_id=message_id)
+            )
 
-    async def grade_students(self, candidates: set[str], mark: int | str) -> list[str]:
-        async with ASession() as session:
-            course_info = await self._get_course(session, loud=True)
+    async def mark_present(self, candidates: set[str]) -> list[str]:
+        """
+        marks students as present and returns skipped candidates.
+        Single statement resolves usernames, inserts attendances for the current lesson and counts them in stats
+        """
+        async with self._transaction() as session:
+            students = (
+                select(User.id, Course.current_lesson_id)
+                .join(UserCourseAssociation, UserCourseAssociation.user_id == User.id)
+                .join(Course, Course.id == UserCourseAssociation.course_id)
+                .where(Course.chat_id == self.chat_id)
+                .where(Course.current_lesson_id.is_not(None))
+                .where(UserCourseAssociation.teacher.is_(False))
+                .where(User.username.in_(candidates))
+            )
+            inserted = (
+                insert(Attendance)
+                .from_select(['user_id', 'lesson_id'], students)
+                .on_conflict_do_nothing(index_elements=[Attendance.user_id, Attendance.lesson_id])
+                .returning(Attendance.user_id)
+                .cte('inserted')
+            )
+            counted = (
+                insert(StudentStats)
+                .from_select(
+                    ['course_id', 'user_id', 'attendance_count'],
+                    select(Course.id, inserted.c.user_id, literal(1))
+                    .select_from(inserted)
+                    .join(Course, Course.chat_id == self.chat_id)
+                )
+                .on_conflict_do_update(
+                    index_elements=[StudentStats.course_id, StudentStats.user_id],
+                    set_={'attendance_count': StudentStats.attendance_count + 1}
+                )
+                .returning(StudentStats.user_id)
+                .cte('counted')
+            )
 
-            course = course_info.course
+            result = await session.execute(
+                select(User.username).join(counted, counted.c.user_id == User.id)
+            )
+            present = set(result.scalars().all())
 
-            if not await course.awaitable_attrs.lessons:
-                raise LessonNotFoundError()
+            if not present:
+                # nothing inserted, tell missing lesson apart from all candidates being skipped
+                await self._get_current_lesson_id(session)
 
-            skipped: list[str] = []
-            performances: list[Attendance] = []
+            return [candidate for candidate in candidates if candidate not in present]
 
-            stmt = (
-                select(User.username, Attendance)
+    async def grade_students(self, candidates: set[str], mark: int | str) -> list[str]:
+        """
+        grades students present at the current lesson and returns skipped candidates.
+        Single statement updates attendances and applies the change to stats using previous marks
+        """
+        async with self._transaction() as session:
+            previous = (
+                select(
+                    Attendance.id,
+                    Attendance.user_id,
+                    User.username,
+                    Attendance.grade.label('previous_grade'),
+                    Attendance.participation.label('previous_participation'),
+                )
                 .join(User, Attendance.user_id == User.id)
                 .join(UserCourseAssociation, UserCourseAssociation.user_id == User.id)
-                .where(Attendance.lesson_id == course.lessons[-1].id)
+                .where(Attendance.lesson_id == self.current_lesson_subquery)
                 .where(User.username.in_(candidates))
-                .where(UserCourseAssociation.course_id == course.id)
+                .where(UserCourseAssociation.course_id == self.course_id_subquery)
+                .subquery('previous')
             )
 
-            result = await session.execute(stmt)
-            result = result.all()
+            if (participation := PARTICIPATION_TYPES.get(mark)) is not None:
+                marked = {'participation': participation}
+            else:
+                marked = {'grade': mark}
+
+            graded = (
+                update(Attendance)
+                .where(Attendance.id == previous.c.id)
+                .values(**marked)
+                .returning(
+                    previous.c.user_id, previous.c.username,
+                    previous.c.previous_grade, previous.c.previous_participation
+                )
+                .cte('graded')
+            )
 
-            # Execute the query
-            attendance_by_username: dict[str, Attendance] = dict(result)
+            if participation is not None:
+                # re-marking the same lesson replaces the previous point
+                previous_points = case(
+                    (graded.c.previous_participation.is_(True), 1),
+                    (graded.c.previous_participation.is_(False), -1),
+                    else_=0
+                )
+                stats = {
+                    'participation_balance':
+                        StudentStats.participation_balance + (1 if participation else -1) - previous_points
+                }
+            else:
+                # only the current lesson is graded, so its previous grade is the last one in the list
+                without_last = StudentStats.grades[1:func.cardinality(StudentStats.grades) - 1]
+                stats = {'grades': case(
+                    (graded.c.previous_grade.is_not(None), func.array_append(without_last, mark)),
+                    else_=func.array_append(StudentStats.grades, mark)
+                )}
+
+            counted = (
+                update(StudentStats)
+                .where(StudentStats.user_id == graded.c.user_id)
+                .where(StudentStats.course_id == self.course_id_subquery)
+                .values(**stats)
+                .returning(StudentStats.user_id)
+                .cte('counted')
+            )
 
-            for candidate in candidates:
-                if attendance := attendance_by_username.get(candidate):
-                    if (participation := PARTICIPATION_TYPES.get(mark)) is not None:
-                        attendance.participation = participation
-                    else:
-                        attendance.grade = mark
-                    performances.append(attendance)
-                else:
-                    skipped.append(candidate)
+            result = await session.execute(
+                select(graded.c.username).outerjoin(counted, counted.c.user_id == graded.c.user_id)
+            )
+            graded_usernames = set(result.scalars().all())
 
-            session.add_all(performances)
-            await session.commit()
+            if not graded_usernames:
+                # nothing updated, tell missing lesson apart from all candidates being skipped
+                await self._get_current_lesson_id(session)
 
-            return skipped
+            return [candidate for candidate in candidates if candidate not in graded_usernames]
 
     async def get_attendance(self) -> dict[str, int]:
         """returns usernames to amount of lessons they attended"""
 
-        async with ASession() as session:
-            stmt = (
-                select(User.username, func.count(Attendance.id).label('attendance_count'))
-                .join(Attendance, Attendance.user_id == User.id)
-                .join(Lesson, Attendance.lesson_id == Lesson.id)
-                .join(Course, Course.id == Lesson.course_id)
-                .where(Course.chat_id == self.chat_id)
-                .where(User.id.in_(select(self.course_related_subquery.c.user_id)))
-                .group_by(User.username)
-            )
+        async with self._transaction() as session:
+            stmt = self._stats_query(StudentStats.attendance_count)
 
             result = await session.execute(stmt)
             attendances = result.all()
 
             return dict(attendances)
 
-    async def get_performance(self, fetch_grades: bool = False) -> dict[str, list[int | bool]]:
-        async with ASession() as session:
-            stmt = (
-                select(User.username, Attendance.grade if fetch_grades else Attendance.participation)
-                .join(Attendance, Attendance.user_id == User.id)
-                .join(Lesson, Attendance.lesson_id == Lesson.id)
-                .join(Course, Course.id == Lesson.course_id)
-                .where(Course.chat_id == self.chat_id)
-                .where(User.id.in_(select(self.course_related_subquery.c.user_id)))
-            )
+    async def get_performance(self, fetch_grades: bool = False) -> dict[str, list[int] | int]:
+        """returns usernames to list of grades or to participation balance"""
+
+        async with self._transaction() as session:
+            stmt = self._stats_query(StudentStats.grades if fetch_grades else StudentStats.participation_balance)
 
             result = await session.execute(stmt)
             performances = result.all()
 
-            performance_by_student = defaultdict(list)
+            return dict(performances)
+
+    async def get_stats(self, usernames: set[str] | None = None) -> dict[str, StudentStats]:
+        """
+        returns usernames to their stats for students present at the current lesson, who make up its live summary,
+        of all of them unless usernames are given
+        """
 
-            for username, participation in performances:
-                performance_by_student[username].append(participation)
+        async with self._transaction() as session:
+            stmt = self._stats_query(StudentStats).join(Attendance, and_(
+                Attendance.user_id == User.id, Attendance.lesson_id == self.current_lesson_subquery
+            ))
 
-            return performance_by_student
+            if usernames is not None:
+                stmt = stmt.where(User.username.in_(usernames))
 
-    async def _get_presented(self, session: ASession) -> list[str]:
-        latest_lesson_date_subquery = (
-            select(func.max(Lesson.id))
-            .join(Course, Course.id == Lesson.course_id)
+            result = await session.execute(stmt)
+
+            return dict(result.all())
+
+    def _stats_query(self, column):
+        return (
+            select(User.username, column)
+            .join(StudentStats, StudentStats.user_id == User.id)
+            .join(Course, Course.id == StudentStats.course_id)
             .where(Course.chat_id == self.chat_id)
-        ).scalar_subquery()
+            .where(User.id.in_(select(self.course_related_subquery.c.user_id)))
+        )
+
+    async def rebuild_stats(self):
+        """recomputes student stats of the course from attendances"""
+        async with self._transaction() as session:
+            course_info = await self._get_course(session, loud=True)
+            await session.execute(_rebuild_stats_statement(course_info.course.id))
+
+    async def get_lessons(self) -> list[Lesson]:
+        """lessons of the course in order they were started"""
+        async with self._transaction() as session:
+            result = await session.execute(
+                select(Lesson).where(Lesson.course_id == self.course_id_subquery).order_by(Lesson.id)
+            )
+
+            return list(result.scalars().all())
+
+    async def stream_gradebook(self) -> AsyncIterator[tuple[str, str, list[bool], list[int | None], list[bool | None]]]:
+        """
+        Yields students with their attendance, grades and participation per lesson ordered like get_lessons.
+        Single query pivots attendances into arrays, rows are streamed from a server-side cursor
+        """
+        lessons = select(Lesson.id).where(Lesson.course_id == self.course_id_subquery).subquery('course_lessons')
+        by_lesson = lessons.c.id
 
+        stmt = (
+            select(
+                User.username,
+                User.name,
+                func.array_agg(aggregate_order_by(Attendance.id.is_not(None), by_lesson)),
+                func.array_agg(aggregate_order_by(Attendance.grade, by_lesson)),
+                func.array_agg(aggregate_order_by(Attendance.participation, by_lesson)),
+            )
+            .join(UserCourseAssociation, UserCourseAssociation.user_id == User.id)
+            .join(lessons, literal(True))
+            .outerjoin(Attendance, and_(Attendance.user_id == User.id, Attendance.lesson_id == by_lesson))
+            .where(UserCourseAssociation.course_id == self.course_id_subquery)
+            .where(UserCourseAssociation.teacher.is_(False))
+            .group_by(User.id)
+            .order_by(User.username)
+        )
+
+        async with self._transaction() as session:
+            result = await session.stream(stmt.execution_options(yield_per=GRADEBOOK_BATCH_SIZE))
+            async for row in result:
+                yield tuple(row)
+
+    async def get_final_inputs(self) -> list[tuple]:
+        """stats of every student of the course for final grading, see _final_inputs_query"""
+        async with self._transaction() as session:
+            result = await session.execute(_final_inputs_query().where(Course.chat_id == self.chat_id))
+
+            return [tuple(row) for row in result]
+
+    async def add_timer(self, due_at: datetime, text: str):
+        """schedules text to be sent to the chat by the scheduler once due"""
+        async with self._transaction() as session:
+            session.add(Timer(chat_id=self.chat_id, due_at=due_at, text=text))
+
+    async def _get_presented(self, session: AsyncSession) -> list[str]:
         stmt = (
             select(User.username)
             .join(Attendance, Attendance.user_id == User.id)
-            .join(Lesson, Attendance.lesson_id == Lesson.id)
-            .join(Course, Course.id == Lesson.course_id)
-            .where(Course.chat_id == self.chat_id)
-            .where(Lesson.id == latest_lesson_date_subquery)
+            .where(Attendance.lesson_id == self.current_lesson_subquery)
             .where(User.id.in_(select(self.course_related_subquery.c.user_id)))
         )
 
@@ -330,11 +616,26 @@ class DataStorage:
         return presented
 
     async def get_presented(self) -> list[str]:
-        async with ASession() as session:
+        async with self._transaction() as session:
             return await self._get_presented(session)
 
+    async def get_lesson_candidates(self) -> dict[str, bool]:
+        """returns usernames present at the current lesson to whether they have neither grade nor participation yet"""
+
+        async with self._transaction() as session:
+            stmt = (
+                select(User.username, and_(Attendance.grade.is_(None), Attendance.participation.is_(None)))
+                .join(Attendance, Attendance.user_id == User.id)
+                .where(Attendance.lesson_id == self.current_lesson_subquery)
+                .where(User.id.in_(select(self.course_related_subquery.c.user_id)))
+            )
+
+            result = await session.execute(stmt)
+
+            return dict(result.all())
+
     async def remove_student(self, username: str):
-        async with ASession() as session:
+        async with self._transaction() as session:
             result = await session.execute(
                 select(User).filter(User.username == username)
             )
@@ -357,4 +658,115 @@ class DataStorage:
                 raise LogicError('User is not related to course as student')
 
             await session.delete(user_course_assoc)
-            await session.commit()
\ No newline at end of file
+            self._invalidate_course()
+
+
+async def claim_due_timers(session: AsyncSession, limit: int) -> list[Timer]:
+    """
+    Locks up to limit due timers of all chats, timers locked by concurrent schedulers are skipped.
+    NB: locks are held until the session transaction ends, so delivered timers should be removed within it
+    """
+    result = await session.execute(
+        select(Timer)
+        .where(Timer.due_at <= func.now())
+        .order_by(Timer.due_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+
+    return list(result.scalars().all())
+
+
+async def remove_timers(session: AsyncSession, timer_ids: list[int]):
+    await session.execute(delete(Timer).where(Timer.id.in_(timer_ids)))
+
+
+async def purge_processed_updates(ttl: int) -> int:
+    """forgets updates processed more than ttl seconds ago, :return: number of purged updates"""
+    async with ASession() as session:
+        result = await session.execute(
+            delete(ProcessedUpdate).where(ProcessedUpdate.created_at < func.now() - timedelta(seconds=ttl))
+        )
+        await session.commit()
+
+        return result.rowcount
+
+
+def _rebuild_stats_statement(course_id: int | None = None):
+    points = case((Attendance.participation.is_(True), 1), (Attendance.participation.is_(False), -1), else_=0)
+    grades = func.array_agg(aggregate_order_by(Attendance.grade, Attendance.lesson_id))
+
+    stmt = (
+        select(
+            Lesson.course_id,
+            Attendance.user_id,
+            func.count(Attendance.id),
+            func.coalesce(func.sum(points), 0),
+            func.coalesce(grades.filter(Attendance.grade.is_not(None)), literal_column("'{}'")),
+        )
+        .join(Lesson, Lesson.id == Attendance.lesson_id)
+        .group_by(Lesson.course_id, Attendance.user_id)
+    )
+
+    if course_id is not None:
+        stmt = stmt.where(Lesson.course_id == course_id)
+
+    columns = ['course_id', 'user_id', 'attendance_count', 'participation_balance', 'grades']
+    upsert = insert(StudentStats).from_select(columns, stmt)
+
+    return upsert.on_conflict_do_update(
+        index_elements=[StudentStats.course_id, StudentStats.user_id],
+        set_={column: upsert.excluded[column] for column in columns[2:]}
+    )
+
+
+def _final_inputs_query():
+    """
+    course id, title, group and exam weight, count of its lessons,
+    username, attendance count, participation balance and grades of every student, ordered by course and username
+    """
+    # correlated, so only lessons of selected courses are counted through ix_lessons_course_id_id
+    lessons = select(func.count()).where(Lesson.course_id == Course.id).scalar_subquery()
+
+    return (
+        select(
+            Course.id, Course.title, Course.group, Course.exam_weight,
+            lessons,
+            User.username,
+            func.coalesce(StudentStats.attendance_count, 0),
+            func.coalesce(StudentStats.participation_balance, 0),
+            func.coalesce(StudentStats.grades, literal_column("'{}'")),
+        )
+        .join(UserCourseAssociation, UserCourseAssociation.course_id == Course.id)
+        .join(User, User.id == UserCourseAssociation.user_id)
+        # student who never attended has no stats yet and still gets a final
+        .outerjoin(StudentStats, and_(
+            StudentStats.course_id == Course.id, StudentStats.user_id == UserCourseAssociation.user_id
+        ))
+        .where(UserCourseAssociation.teacher.is_(False))
+        .order_by(Course.id, User.username)
+    )
+
+
+async def get_year_final_inputs(year: int) -> list[tuple]:
+    """stats of every student of every course of the year for final grading, see _final_inputs_query"""
+    async with ASession() as session:
+        result = await session.execute(_final_inputs_query().where(Course.year == year))
+
+        return [tuple(row) for row in result]
+
+
+async def backfill():
+    """fills derived data of every course: current lesson pointer and student stats"""
+    async with ASession() as session:
+        await session.execute(
+            update(Course)
+            .where(Course.current_lesson_id.is_(None))
+            .values(current_lesson_id=select(func.max(Lesson.id)).where(Lesson.course_id == Course.id).scalar_subquery())
+        )
+        await session.execute(_rebuild_stats_statement())
+        await session.commit()
+
+
+if __name__ == '__main__':
+    asyncio.run(backfill())
@@ -1,11 +1,18 @@
 import asyncio
-from datetime import date
+from datetime import date, datetime
+from uuid import uuid4
 
-from sqlalchemy import ForeignKey, UniqueConstraint
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncAttrs
+from sqlalchemy import ForeignKey, UniqueConstraint, Integer, Index, DateTime, BigInteger, func, text
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncAttrs, AsyncEngine, AsyncSession
 from sqlalchemy.orm import mapped_column, Mapped, relationship, DeclarativeBase
 
-from conf import DB_USER, DB_PASS, DB_HOST, DB_PORT, DB_NAME
+from conf import (
+    DB_USER, DB_PASS, DB_HOST, DB_PORT, DB_NAME,
+    DB_POOL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_PRE_PING, DB_PGBOUNCER
+)
+from pool import MeteredQueuePool, MeteredNullPool, pool_metrics
+from tracing import instrument_engine
 
 ALCHEMY_ECHO = False
 DESCRIBE = False
@@ -19,6 +26,10 @@ class UserCourseAssociation(Base):
     """intermediate table for users related to courses"""
 
     __tablename__ = "users_courses"
+    __table_args__ = (
+        # course roster, primary key only serves lookups by user
+        Index('ix_users_courses_course_id_user_id', 'course_id', 'user_id'),
+    )
 
     user_id: Mapped[int] = mapped_column(ForeignKey('users.id'), primary_key=True)
     course_id: Mapped[int] = mapped_column(ForeignKey('courses.id'), primary_key=True)
@@ -53,26 +64,40 @@ class Course(Base):
     year: Mapped[int]
     exam_weight: Mapped[int | None] = mapped_column(comment='exam weight in percent', default=40)
     group: Mapped[str]
+    current_lesson_id: Mapped[int | None] = mapped_column(
+        ForeignKey('lessons.id', use_alter=True, name='fk_courses_current_lesson_id'),
+        comment='lesson started last, set by start_lesson'
+    )
 
-    lessons: Mapped[list['Lesson']] = relationship(back_populates='course')
+    lessons: Mapped[list['Lesson']] = relationship(back_populates='course', foreign_keys='Lesson.course_id')
     users: Mapped[list['UserCourseAssociation']] = relationship(back_populates='course')
 
 
 class Lesson(Base):
     __tablename__ = "lessons"
+    __table_args__ = (
+        # latest lesson of a course
+        Index('ix_lessons_course_id_id', 'course_id', 'id'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     title: Mapped[str]
     type: Mapped[int] = mapped_column(comment='0-lecture 1-lab 2-seminar')
     date: Mapped[date]
     course_id: Mapped[int] = mapped_column(ForeignKey('courses.id'))
+    summary_message_id: Mapped[int | None] = mapped_column(comment='pinned message edited with live summary')
 
-    course: Mapped['Course'] = relationship(back_populates='lessons')
+    course: Mapped['Course'] = relationship(back_populates='lessons', foreign_keys=[course_id])
     attendances: Mapped[list['Attendance']] = relationship(back_populates='lesson')
 
 
 class Attendance(Base):
     __tablename__ = "attendances"
+    __table_args__ = (
+        UniqueConstraint('user_id', 'lesson_id', name='uq_attendances_user_id_lesson_id'),
+        # students of a lesson
+        Index('ix_attendances_lesson_id_user_id', 'lesson_id', 'user_id'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey('users.id'))
@@ -84,26 +109,130 @@ class Attendance(Base):
     lesson: Mapped['Lesson'] = relationship(back_populates='attendances')
 
 
-async_engine = create_async_engine(
-    f'postgresql+asyncpg://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}',
-    pool_pre_ping=True, echo=ALCHEMY_ECHO
+class StudentStats(Base):
+    """per student course summary maintained in the same transaction as attendances"""
+
+    __tablename__ = "student_stats"
+
+    course_id: Mapped[int] = mapped_column(ForeignKey('courses.id'), primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey('users.id'), primary_key=True)
+    attendance_count: Mapped[int] = mapped_column(server_default='0')
+    participation_balance: Mapped[int] = mapped_column(server_default='0', comment='pluses minus minuses')
+    grades: Mapped[list[int]] = mapped_column(ARRAY(Integer), server_default='{}', comment='ordered by lesson')
+
+
+class Timer(Base):
+    """pending /timer notification, deleted by the scheduler once delivered"""
+
+    __tablename__ = "timers"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    chat_id: Mapped[str]
+    due_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), index=True)
+    text: Mapped[str]
+
+
+class ProcessedUpdate(Base):
+    """update handled by a unit of work, guards against redeliveries of webhook updates until purged"""
+
+    __tablename__ = "processed_updates"
+
+    update_id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), index=True)
+
+
+# create_all only creates missing tables, so columns, indexes and constraints added to existing ones
+# are applied by these statements, each of them is a no-op on an up-to-date database
+MIGRATIONS = (
+    # duplicates were possible before the unique constraint, the first attendance is kept
+    'DELETE FROM attendances a USING attendances b '
+    'WHERE a.user_id = b.user_id AND a.lesson_id = b.lesson_id AND a.id > b.id',
+    'DO $$ BEGIN '
+    'ALTER TABLE attendances ADD CONSTRAINT uq_attendances_user_id_lesson_id UNIQUE (user_id, lesson_id); '
+    'EXCEPTION WHEN duplicate_table OR duplicate_object THEN NULL; '
+    'END $$',
+    'CREATE INDEX IF NOT EXISTS ix_attendances_lesson_id_user_id ON attendances (lesson_id, user_id)',
+    'CREATE INDEX IF NOT EXISTS ix_lessons_course_id_id ON lessons (course_id, id)',
+    'CREATE INDEX IF NOT EXISTS ix_users_courses_course_id_user_id ON users_courses (course_id, user_id)',
+    # filled for existing courses by python data.py
+    'ALTER TABLE courses ADD COLUMN IF NOT EXISTS current_lesson_id INTEGER',
+    'DO $$ BEGIN '
+    'ALTER TABLE courses ADD CONSTRAINT fk_courses_current_lesson_id '
+    'FOREIGN KEY (current_lesson_id) REFERENCES lessons (id); '
+    'EXCEPTION WHEN duplicate_object THEN NULL; '
+    'END $$',
+    'ALTER TABLE lessons ADD COLUMN IF NOT EXISTS summary_message_id INTEGER',
 )
-ASession = async_sessionmaker(
-    bind=async_engine,
+
+
+_engine: AsyncEngine | None = None
+
+
+def get_engine() -> AsyncEngine:
+    """engine is created on first use, so that importing models neither reads pool settings nor builds a pool"""
+    global _engine
+
+    if _engine is None:
+        options = {}
+        if DB_POOL == 'null':
+            options['poolclass'] = MeteredNullPool
+        else:
+            options.update(
+                poolclass=MeteredQueuePool,
+                pool_size=DB_POOL_SIZE,
+                max_overflow=DB_MAX_OVERFLOW,
+                pool_timeout=DB_POOL_TIMEOUT,
+                # recycling connections before server or network drops them is cheaper than a ping per checkout
+                pool_recycle=DB_POOL_RECYCLE,
+                pool_pre_ping=DB_PRE_PING,
+            )
+
+        if DB_PGBOUNCER:
+            options['connect_args'] = {
+                'statement_cache_size': 0,
+                'prepared_statement_cache_size': 0,
+                'prepared_statement_name_func': lambda: f'__asyncpg_{uuid4()}__',
+            }
+
+        _engine = create_async_engine(
+            f'postgresql+asyncpg://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}',
+            echo=ALCHEMY_ECHO, **options
+        )
+        pool_metrics.listen(_engine.sync_engine)
+        instrument_engine(_engine.sync_engine)
+
+    return _engine
+
+
+class _LazySessionMaker(async_sessionmaker):
+    """binds sessions to the engine when they are opened and not when the module is imported"""
+
+    def __call__(self, **local_kw) -> AsyncSession:
+        local_kw.setdefault('bind', get_engine())
+        return super().__call__(**local_kw)
+
+
+ASession = _LazySessionMaker(
     expire_on_commit=False,
 )
 
 
 async def main():
     if DESCRIBE:
-        from sqlalchemy.sql.ddl import CreateTable
+        from sqlalchemy.sql.ddl import CreateTable, CreateIndex
         from sqlalchemy.dialects.postgresql import dialect
         for table in Base.metadata.sorted_tables:
             create_table_sql = f'{(CreateTable(table).compile(dialect=dialect()))}'
             print(create_table_sql)
+            for index in table.indexes:
+                print(f'{CreateIndex(index).compile(dialect=dialect())};')
+        for statement in MIGRATIONS:
+            print(f'{statement};')
     else:
-        async with async_engine.begin() as conn:
+        async with get_engine().begin() as conn:
             await conn.run_sync(Base.metadata.create_all)
+            for statement in MIGRATIONS:
+                await conn.execute(text(statement))
 
 
 if __name__ == '__main__':
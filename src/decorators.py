@@ -1,32 +1,65 @@
+from typing import TYPE_CHECKING
+
 from telegram import Update
 from telegram.ext import ContextTypes
 
-from data import DataStorage
+from bot import Bot
 from exceptions import NotFoundError
 from logs import custom_logger
 
+if TYPE_CHECKING:
+    from data import DataStorage
 
-def teacher_only(func):
-    """Basic role model restriction"""
+
+def unit_of_work(func):
+    """
+    One session and transaction per update.
+    Wrapped callback receives DataStorage bound to the session, changes are committed once it returns.
+    Callback waiting for a bot api response commits its changes first with ds.commit(),
+    so the transaction does not hold locks and a pooled connection while telegram or the outbox is awaited.
+    Update is claimed in the same transaction, redelivered one is acknowledged without calling the callback.
+    NB: data layer and ORM are imported by the first update that needs them, not on cold start
+    """
     async def decorated(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        from data import DataStorage
+        from db import ASession
+
+        async with ASession() as session:
+            ds = DataStorage(update.effective_chat.id, session)
+            if not await ds.claim_update(update.update_id):
+                custom_logger.info('Duplicate update', extra={'update_id': update.update_id})
+                return
+
+            await func(update, context, ds)
+            await ds.commit()
+
+    return decorated
+
+
+def teacher_only(func):
+    """
+    Basic role model restriction, expects to be wrapped by unit_of_work.
+    Wrapped callback receives the same DataStorage that already resolved the course, so it is not looked up twice
+    """
+    async def decorated(update: Update, context: ContextTypes.DEFAULT_TYPE, ds: 'DataStorage'):
 
         chat_id = update.effective_chat.id
         tg_user_id = f'{update.effective_user.id}'
 
-        ds = DataStorage(chat_id)
         try:
             is_teacher = await ds.check_is_teacher(tg_user_id)
         except NotFoundError as e:
             msg = f'{chat_id}: {e.__doc__}'
             custom_logger.warning(msg)
-            return await context.bot.send_message(chat_id=chat_id, text='Teacher should start the bot first')
+            return await Bot.send_message(context, chat_id=chat_id, text='Teacher should start the bot first')
 
         if is_teacher:
-            await func(update, context)
+            await func(update, context, ds)
         else:
-            await context.bot.send_message(
+            await Bot.send_message(
+                context,
                 chat_id=update.effective_chat.id,
                 text=f'Only teacher can perform this action. If you are a teacher, press /start'
             )
 
-    return decorated
\ No newline at end of file
+    return decorated
@@ -0,0 +1,88 @@
+"""
+Final grades computed for all students at once with numpy arrays.
+Attendance, participation and grades make up coursework, Course.exam_weight percent of the final is left for the exam.
+NB: numpy is imported on first use, so that cold starts of other commands don't pay for it
+"""
+import asyncio
+import csv
+import sys
+from dataclasses import dataclass
+from datetime import date
+from itertools import chain
+from typing import Sequence, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import numpy as np
+
+MAX_GRADE = 10
+# share of coursework given by attending every lesson, the rest comes from grades
+ATTENDANCE_SHARE = 0.2
+# coursework points per participation plus, minuses take them away
+PARTICIPATION_POINT = 0.25
+# courses created before exam_weight was filled in
+DEFAULT_EXAM_WEIGHT = 40
+
+
+@dataclass
+class Finals:
+    """results of compute_finals, arrays are aligned with usernames"""
+    course_ids: list[int]
+    usernames: list[str]
+    coursework: 'np.ndarray'
+    final: 'np.ndarray'
+    exam_weight: 'np.ndarray'
+
+
+def compute_finals(rows: Sequence[tuple]) -> Finals:
+    """
+    :param rows: as returned by DataStorage.get_final_inputs or data.get_year_final_inputs, one per student
+    :return: coursework out of MAX_GRADE and points of the final earned so far, the rest is exam_weight
+    """
+    import numpy as np
+
+    course_ids, _, _, exam_weight, lessons, usernames, attended, participation, grades = (
+        zip(*rows) if rows else ([],) * 9
+    )
+
+    lessons = np.asarray(lessons, dtype=float)
+    attended = np.asarray(attended, dtype=float)
+    participation = np.asarray(participation, dtype=float)
+    exam_weight = np.array([DEFAULT_EXAM_WEIGHT if weight is None else weight for weight in exam_weight], dtype=float)
+
+    # ragged grades are padded into a students x grades matrix
+    counts = np.fromiter(map(len, grades), dtype=int, count=len(grades))
+    matrix = np.zeros((len(grades), counts.max(initial=0)))
+    matrix[np.arange(matrix.shape[1]) < counts[:, None]] = np.fromiter(chain.from_iterable(grades), dtype=float)
+
+    average_grade = np.divide(matrix.sum(axis=1), counts, out=np.zeros(len(counts)), where=counts > 0)
+    attendance_rate = np.divide(attended, lessons, out=np.zeros(len(lessons)), where=lessons > 0)
+
+    coursework = np.clip(
+        (1 - ATTENDANCE_SHARE) * average_grade
+        + ATTENDANCE_SHARE * MAX_GRADE * attendance_rate
+        + PARTICIPATION_POINT * participation,
+        0, MAX_GRADE
+    )
+    final = coursework * (1 - exam_weight / 100)
+
+    return Finals(list(course_ids), list(usernames), coursework, final, exam_weight)
+
+
+async def export_year(year: int, output=sys.stdout):
+    """writes finals of every student of every course of the year as csv"""
+    from data import get_year_final_inputs
+
+    rows = await get_year_final_inputs(year)
+    finals = compute_finals(rows)
+
+    writer = csv.writer(output)
+    writer.writerow(('course', 'group', 'username', 'coursework', 'final', 'exam_weight'))
+    for row, username, coursework, final, weight in zip(
+            rows, finals.usernames, finals.coursework, finals.final, finals.exam_weight
+    ):
+        _, title, group, *_ = row
+        writer.writerow((title, group, username, f'{coursework:.1f}', f'{final:.1f}', f'{weight:.0f}'))
+
+
+if __name__ == '__main__':
+    asyncio.run(export_year(int(sys.argv[1]) if len(sys.argv) > 1 else date.today().year))
@@ -1,28 +1,44 @@
 from telegram import Update
-from telegram.ext import CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import BaseHandler, CommandHandler, MessageHandler, filters, ContextTypes
 
-from callbacks import help, start, stop, unknown, randomize, ignore, grade, register, present, timer, lesson
+from bot import Bot
+from callbacks import (
+    help, start, stop, unknown, randomize, ignore, grade, register, present, timer, lesson, stats, final
+)
 from logs import custom_logger
 
-HANDLERS = (
-    CommandHandler('help', help, block=False),
-    CommandHandler('start', start, block=False),
-    CommandHandler('stop', stop, block=False),
-    CommandHandler('random', randomize, block=False),
-    CommandHandler('ignore', ignore, block=False),
-    CommandHandler('grade', grade, block=False),
-    CommandHandler('register', register, block=False),
-    CommandHandler('present', present, block=False),
-    CommandHandler('timer', timer, block=False),
-    CommandHandler('lesson', lesson, block=False),
-    MessageHandler(filters.COMMAND, unknown, block=False)
-)
+
+def build_handlers(block: bool = False) -> tuple[BaseHandler, ...]:
+    """
+    block=False runs callbacks in background tasks detached from the update,
+    block=True makes process_update wait for the callback, which serverless invocations
+    and bounded concurrent processing in TgUpdater rely on
+    """
+    return (
+        CommandHandler('help', help, block=block),
+        CommandHandler('start', start, block=block),
+        CommandHandler('stop', stop, block=block),
+        CommandHandler('random', randomize, block=block),
+        CommandHandler('ignore', ignore, block=block),
+        CommandHandler('grade', grade, block=block),
+        CommandHandler('register', register, block=block),
+        CommandHandler('present', present, block=block),
+        CommandHandler('timer', timer, block=block),
+        CommandHandler('lesson', lesson, block=block),
+        CommandHandler('stats', stats, block=block),
+        CommandHandler('final', final, block=block),
+        MessageHandler(filters.COMMAND, unknown, block=block)
+    )
+
+
+HANDLERS = build_handlers()
 
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     """Log the error and send a message to the user."""
     custom_logger.error(msg='Exception while handling an update:', exc_info=context.error)
 
-    if isinstance(update, Update):
-        await update.message.reply_text('An error occurred, please try again later.')
-
+    if isinstance(update, Update) and update.effective_chat:
+        await Bot.send_message(
+            context, chat_id=update.effective_chat.id, text='An error occurred, please try again later.'
+        )
@@ -1,12 +1,36 @@
 import json
 
-from conf import BOT_TOKEN
+from conf import BOT_TOKEN, WARM_START
+from logs import flush
 from tg import TgUpdater
 
+# reused across invocations of a warm container
+updater: TgUpdater | None = None
+
+
+def get_updater() -> TgUpdater:
+    global updater
+
+    if updater is None or not WARM_START:
+        updater = TgUpdater(BOT_TOKEN, serverless=True)
+
+    return updater
+
 
 async def handler(event, context):
-    result = await TgUpdater(BOT_TOKEN).cloud_run(event)
+    result = await get_updater().cloud_run(event, keep_alive=WARM_START)
+    flush()
+    return {
+        'statusCode': 200,
+        'body': result if isinstance(result, str) else json.dumps(result)
+    }
+
+
+async def timer_handler(event, context):
+    """entry point of a periodic trigger delivering due /timer notifications"""
+    delivered = await get_updater().run_timers(keep_alive=WARM_START)
+    flush()
     return {
         'statusCode': 200,
-        'body': result
+        'body': f'{delivered}'
     }
@@ -1,6 +1,15 @@
+import atexit
+import copy
 import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
+
 from pythonjsonlogger import jsonlogger
 
+from cache import TTLCache
+from conf import LOG_LEVEL, LOG_WARNING_BURST, LOG_WARNING_WINDOW
+
+
 class YcLoggingFormatter(jsonlogger.JsonFormatter):
     def add_fields(self, log_record, record, message_dict):
         super(YcLoggingFormatter, self).add_fields(log_record, record, message_dict)
@@ -8,9 +17,75 @@ class YcLoggingFormatter(jsonlogger.JsonFormatter):
         log_record['level'] = str.replace(str.replace(record.levelname, "WARNING", "WARN"), "CRITICAL", "FATAL")
 
 
+class RepeatedWarningFilter(logging.Filter):
+    """
+    Lets through `burst` warnings with the same message per chat within `window` seconds and drops the rest,
+    the first warning of the next window carries the number of dropped ones
+    """
+
+    def __init__(self, burst: int, window: float):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        # (chat_id, message template) -> [window start, passed, suppressed]
+        self.windows = TTLCache(maxsize=4096)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno != logging.WARNING:
+            return True
+
+        from tracing import current_trace
+        trace = current_trace.get()
+        key = (trace.chat_id if trace else None, record.msg)
+
+        if (counts := self.windows.get(key)) is None or record.created - counts[0] >= self.window:
+            if counts and counts[2]:
+                record.suppressed = counts[2]
+            self.windows.set(key, [record.created, 1, 0])
+            return True
+
+        if counts[1] >= self.burst:
+            counts[2] += 1
+            return False
+
+        counts[1] += 1
+        return True
+
+
+class LocalQueueHandler(QueueHandler):
+    """
+    Enqueues records for a listener of the same process without formatting them,
+    so exc_info reaches the formatter as a field of its own instead of being folded into the message
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # arguments are rendered now, they may be changed before the listener gets to the record
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+
+        return record
+
+
+# records are formatted and written by the listener thread, so the event loop only enqueues them
+log_queue: Queue = Queue()
+
 logHandler = logging.StreamHandler()
 logHandler.setFormatter(YcLoggingFormatter('%(message)s %(level)s %(logger)s'))
 
+listener = QueueListener(log_queue, logHandler, respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)
+
+queueHandler = LocalQueueHandler(log_queue)
+queueHandler.addFilter(RepeatedWarningFilter(LOG_WARNING_BURST, LOG_WARNING_WINDOW))
+
 custom_logger = logging.getLogger('custom')
-custom_logger.addHandler(logHandler)
-custom_logger.setLevel(logging.DEBUG)
\ No newline at end of file
+custom_logger.addHandler(queueHandler)
+custom_logger.setLevel(LOG_LEVEL)
+
+
+def flush():
+    """waits until queued records are written, serverless container may be frozen right after it returns"""
+    log_queue.join()
+    logHandler.flush()
@@ -0,0 +1,84 @@
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Iterable, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from db import User
+
+# trigram similarity from which the student is suggested for a skipped name
+SUGGEST_SIMILARITY = 0.3
+
+
+def trigrams(text: str) -> set[str]:
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+@dataclass
+class Resolution:
+    usernames: dict[str, str] = field(default_factory=dict)
+    skipped: list[str] = field(default_factory=list)
+    suggestions: dict[str, str] = field(default_factory=dict)
+
+    @property
+    def resolved(self) -> set[str]:
+        return set(self.usernames.values())
+
+
+class NameIndex:
+    """
+    Usernames and full names of course students.
+    Resolves exact usernames and unique case-insensitive usernames or full names,
+    misspelled ones are skipped with the most similar student by trigrams as a suggestion,
+    since a similar name may as well belong to a student missing from the index
+    """
+
+    def __init__(self, students: Iterable['User']):
+        self.usernames: set[str] = set()
+        # lowercased username or full name -> usernames
+        self.folded: dict[str, set[str]] = {}
+        # trigram -> keys of folded containing it
+        self.postings: dict[str, set[str]] = {}
+        self.sizes: dict[str, int] = {}
+
+        for student in students:
+            self.usernames.add(student.username)
+            for key in {student.username.lower(), (student.name or '').lower()} - {''}:
+                self.folded.setdefault(key, set()).add(student.username)
+
+        for key in self.folded:
+            grams = trigrams(key)
+            self.sizes[key] = len(grams)
+            for gram in grams:
+                self.postings.setdefault(gram, set()).add(key)
+
+    def similar(self, name: str) -> list[tuple[float, str]]:
+        """usernames sharing trigrams with the name, most similar first"""
+        grams = trigrams(name.lower())
+        shared = Counter(key for gram in grams for key in self.postings.get(gram, ()))
+
+        best: dict[str, float] = {}
+        for key, count in shared.items():
+            similarity = count / (len(grams) + self.sizes[key] - count)
+            for username in self.folded[key]:
+                best[username] = max(best.get(username, 0.0), similarity)
+
+        return sorted(((similarity, username) for username, similarity in best.items()), reverse=True)
+
+    def resolve(self, candidates: Iterable[str]) -> Resolution:
+        resolution = Resolution()
+
+        for candidate in candidates:
+            if candidate in self.usernames:
+                resolution.usernames[candidate] = candidate
+                continue
+
+            if len(matches := self.folded.get(candidate.lower(), ())) == 1:
+                resolution.usernames[candidate] = next(iter(matches))
+                continue
+
+            resolution.skipped.append(candidate)
+            if (similar := self.similar(candidate)) and similar[0][0] >= SUGGEST_SIMILARITY:
+                resolution.suggestions[candidate] = similar[0][1]
+
+        return resolution
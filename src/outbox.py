@@ -0,0 +1,210 @@
+import asyncio
+import heapq
+from dataclasses import dataclass, field
+from datetime import timedelta
+from enum import IntEnum
+from itertools import count
+from time import monotonic
+from typing import IO
+
+from telegram import Bot, Message
+from telegram.error import RetryAfter
+
+from cache import TTLCache
+from conf import OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE
+from logs import custom_logger
+
+MAX_MESSAGE_LENGTH = 4096
+
+
+class Priority(IntEnum):
+    TEACHER = 0
+    STUDENT = 1
+
+
+class TokenBucket:
+    """Rate limiter, reserve() takes a token in advance and returns how long to wait until it is available"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def reserve(self) -> float:
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+
+        return max(0.0, -self.tokens / self.rate)
+
+
+@dataclass(order=True)
+class _Outgoing:
+    priority: int
+    seq: int
+    text: str = field(compare=False)
+    # None for posted messages nobody waits for
+    future: asyncio.Future | None = field(compare=False)
+    queued_at: float = field(compare=False)
+    # sent as a message of its own, e.g. to be edited later
+    alone: bool = field(compare=False, default=False)
+
+
+class Outbox:
+    """
+    Outbound message queue of the process.
+    Each chat is served by its own worker limited by per chat and global token buckets.
+    Messages queued for a chat while the worker waits are coalesced into one, teacher-facing ones go first
+    """
+
+    def __init__(self, global_rate: float = OUTBOX_GLOBAL_RATE, chat_rate: float = OUTBOX_CHAT_RATE / 60,
+                 chat_burst: int = OUTBOX_CHAT_RATE):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        # bucket idle long enough to refill is the same as a new one
+        self.chat_buckets = TTLCache(maxsize=4096, ttl=chat_burst / chat_rate)
+        self.queues: dict[int, list[_Outgoing]] = {}
+        self.workers: dict[int, asyncio.Task] = {}
+        self._seq = count()
+
+        self.depth = 0
+        self.max_depth = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def post(self, bot: Bot, chat_id: int, text: str, priority: Priority = Priority.STUDENT):
+        """
+        queues message without waiting for delivery, so messages posted one after another by the same callback
+        are coalesced while the worker waits. Failed delivery is only logged
+        """
+        self._enqueue(bot, chat_id, _Outgoing(priority, next(self._seq), text, None, monotonic()))
+
+    async def send(self, bot: Bot, chat_id: int, text: str, priority: Priority = Priority.STUDENT,
+                   coalesce: bool = True) -> Message:
+        """queues message and waits until it is delivered, possibly as a part of a coalesced one unless coalesce=False"""
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(bot, chat_id, _Outgoing(priority, next(self._seq), text, future, monotonic(), not coalesce))
+
+        return await future
+
+    async def edit(self, bot: Bot, chat_id: int, message_id: int, text: str) -> Message | bool:
+        """edits message in place, not queued or coalesced but counted against the same rate limits"""
+        await self._reserve(chat_id)
+
+        return await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+
+    async def send_document(self, bot: Bot, chat_id: int, document: IO[bytes], filename: str) -> Message:
+        """uploads a file, not queued or coalesced but counted against the same rate limits"""
+        await self._reserve(chat_id)
+
+        return await bot.send_document(chat_id=chat_id, document=document, filename=filename)
+
+    async def join(self):
+        """waits until everything queued so far is delivered"""
+        await asyncio.gather(*self.workers.values(), return_exceptions=True)
+
+    def metrics(self) -> dict:
+        return {
+            'outbox_depth': self.depth,
+            'outbox_max_depth': self.max_depth,
+            'outbox_sent': self.sent,
+            'outbox_coalesced': self.coalesced,
+            'outbox_wait_avg': self.wait_total / self.sent if self.sent else 0.0,
+            'outbox_wait_max': self.wait_max,
+        }
+
+    def _enqueue(self, bot: Bot, chat_id: int, item: _Outgoing):
+        heapq.heappush(self.queues.setdefault(chat_id, []), item)
+
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.create_task(self._work(bot, chat_id))
+
+    async def _reserve(self, chat_id: int):
+        await asyncio.sleep(self._chat_bucket(chat_id).reserve())
+        await asyncio.sleep(self.global_bucket.reserve())
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        if (bucket := self.chat_buckets.get(chat_id)) is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+        self.chat_buckets.set(chat_id, bucket)
+
+        return bucket
+
+    def _take(self, queue: list[_Outgoing]) -> list[_Outgoing]:
+        batch = [heapq.heappop(queue)]
+        if batch[0].alone:
+            return batch
+        length = len(batch[0].text)
+
+        while queue and not queue[0].alone and length + 2 + len(queue[0].text) <= MAX_MESSAGE_LENGTH:
+            item = heapq.heappop(queue)
+            length += 2 + len(item.text)
+            batch.append(item)
+
+        return batch
+
+    async def _work(self, bot: Bot, chat_id: int):
+        queue = self.queues[chat_id]
+
+        try:
+            while queue:
+                await asyncio.sleep(self._chat_bucket(chat_id).reserve())
+                await asyncio.sleep(self.global_bucket.reserve())
+
+                batch = self._take(queue)
+                text = '\n\n'.join(item.text for item in batch)
+
+                try:
+                    message = await bot.send_message(chat_id=chat_id, text=text)
+                except RetryAfter as exc:
+                    retry_after = exc.retry_after
+                    if isinstance(retry_after, timedelta):
+                        retry_after = retry_after.total_seconds()
+                    custom_logger.warning('%s: rate limited for %s seconds', chat_id, retry_after)
+
+                    for item in batch:
+                        heapq.heappush(queue, item)
+                    await asyncio.sleep(retry_after)
+                    continue
+                except Exception as exc:
+                    self._settle(batch)
+                    custom_logger.warning('%s: message not sent %s', chat_id, exc)
+                    for item in batch:
+                        if item.future and not item.future.done():
+                            item.future.set_exception(exc)
+                    continue
+
+                self._settle(batch)
+                self.coalesced += len(batch) - 1
+                for item in batch:
+                    if item.future and not item.future.done():
+                        item.future.set_result(message)
+        finally:
+            del self.workers[chat_id]
+            # worker was cancelled, nobody is going to deliver the rest
+            for item in queue:
+                if item.future:
+                    item.future.cancel()
+            self.depth -= len(queue)
+            del self.queues[chat_id]
+
+    def _settle(self, batch: list[_Outgoing]):
+        now = monotonic()
+        self.depth -= len(batch)
+        self.sent += len(batch)
+
+        for item in batch:
+            waited = now - item.queued_at
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+
+outbox = Outbox()
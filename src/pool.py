@@ -0,0 +1,78 @@
+from time import perf_counter
+
+from sqlalchemy import event, Engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+
+
+class PoolMetrics:
+    """
+    Connection usage of the process.
+    max_checked_out of every container adds up to the connections postgres has to allow
+    """
+
+    def __init__(self):
+        self.connects = 0
+        self.checkouts = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.max_overflow = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def listen(self, engine: Engine):
+        event.listen(engine, 'connect', self._on_connect)
+        event.listen(engine, 'checkout', self._on_checkout)
+        event.listen(engine, 'checkin', self._on_checkin)
+
+    def waited(self, pool, seconds: float):
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+        if isinstance(pool, QueuePool):
+            self.max_overflow = max(self.max_overflow, pool.overflow())
+
+    def as_dict(self) -> dict:
+        return {
+            'pool_connects': self.connects,
+            'pool_checkouts': self.checkouts,
+            'pool_checked_out': self.checked_out,
+            'pool_max_checked_out': self.max_checked_out,
+            'pool_max_overflow': self.max_overflow,
+            'pool_wait_avg': self.wait_total / self.checkouts if self.checkouts else 0.0,
+            'pool_wait_max': self.wait_max,
+        }
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        self.checkouts += 1
+        self.checked_out += 1
+        self.max_checked_out = max(self.max_checked_out, self.checked_out)
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        self.checked_out -= 1
+
+
+pool_metrics = PoolMetrics()
+
+
+class MeteredQueuePool(AsyncAdaptedQueuePool):
+    """pool of a long-running process, checkout wait includes connecting when the pool grows"""
+
+    def _do_get(self):
+        started = perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_metrics.waited(self, perf_counter() - started)
+
+
+class MeteredNullPool(NullPool):
+    """connection per checkout, for short-lived containers and external poolers like pgbouncer"""
+
+    def _do_get(self):
+        started = perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_metrics.waited(self, perf_counter() - started)
@@ -0,0 +1,63 @@
+import asyncio
+
+from telegram import Bot
+from telegram.error import Forbidden, BadRequest, ChatMigrated
+
+from conf import TIMER_BATCH_SIZE, DEDUP_TTL
+from logs import custom_logger
+from outbox import outbox
+
+# bot was kicked or chat is gone, such timers are dropped since no retry would deliver them
+PERMANENT_ERRORS = (Forbidden, BadRequest, ChatMigrated)
+
+
+async def deliver_due_timers(bot: Bot, batch_size: int = TIMER_BATCH_SIZE) -> int:
+    """
+    Sends due timers of all chats batch by batch, chats are served concurrently by the outbox.
+    Timers that failed to send for a transient reason, e.g. a network error, stay in the table
+    and are retried on the next run, those that failed for good are dropped.
+    :return: number of delivered timers
+    """
+    from data import claim_due_timers, remove_timers
+    from db import ASession
+
+    delivered = 0
+
+    while True:
+        async with ASession() as session:
+            timers = await claim_due_timers(session, batch_size)
+            if not timers:
+                break
+
+            results = await asyncio.gather(
+                *(outbox.send(bot, int(timer.chat_id), timer.text) for timer in timers),
+                return_exceptions=True
+            )
+
+            sent = []
+            dropped = []
+            for timer, result in zip(timers, results):
+                if isinstance(result, PERMANENT_ERRORS):
+                    custom_logger.warning('%s: timer %s dropped %s', timer.chat_id, timer.id, result)
+                    dropped.append(timer.id)
+                elif isinstance(result, BaseException):
+                    custom_logger.warning('%s: timer %s not delivered %s', timer.chat_id, timer.id, result)
+                else:
+                    sent.append(timer.id)
+
+            await remove_timers(session, sent + dropped)
+            await session.commit()
+
+        delivered += len(sent)
+        # the rest of due timers failed to send for now, they wait for the next run
+        if len(timers) < batch_size or not (sent or dropped):
+            break
+
+    return delivered
+
+
+async def purge_processed_updates(ttl: int = DEDUP_TTL) -> int:
+    """forgets processed updates telegram no longer redelivers, piggybacks on the periodic timer runs"""
+    from data import purge_processed_updates
+
+    return await purge_processed_updates(ttl)
@@ -1,40 +1,243 @@
+import asyncio
 import json
+import signal
+import sys
+from collections import defaultdict
+from typing import Awaitable
+from urllib.parse import urlparse
 
-from telegram import Update, Bot
-from telegram.ext import ApplicationBuilder
+from telegram import Update
+from telegram.ext import ApplicationBuilder, ContextTypes, SimpleUpdateProcessor
+from telegram.request import BaseRequest, HTTPXRequest
 
-from handlers import HANDLERS, error_handler
+from conf import (
+    BOT_API_URL,
+    RUN_MODE, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET, MAX_CONCURRENT_UPDATES, MAX_UPDATE_BACKLOG,
+    TIMER_INTERVAL, DEDUP_CACHE_SIZE, DEDUP_TTL
+)
+from cache import TTLCache
+from handlers import build_handlers, error_handler
 from logs import custom_logger
+from outbox import outbox
+from scheduler import deliver_due_timers, purge_processed_updates
+from tracing import TracedRequest, trace_update, log_histograms
+
+
+class BoundedUpdateProcessor(SimpleUpdateProcessor):
+    """
+    Runs at most max_concurrent_updates updates at once, up to max_backlog more wait for a free slot.
+    Updates arriving over that are dropped, telegram considers them delivered, so each one is logged.
+    NB: process_update of the library is final, so slots are taken in do_process_update
+    and the semaphore of the library only admits one update more than slots and backlog,
+    an update over them gets through it and is shed instead of waiting there
+    """
+
+    def __init__(self, max_concurrent_updates: int, max_backlog: int):
+        super().__init__(max_concurrent_updates + max_backlog + 1)
+        self.slots = asyncio.Semaphore(max_concurrent_updates)
+        self.max_pending = max_concurrent_updates + max_backlog
+        self.pending = 0
+        self.shed = 0
+
+    async def do_process_update(self, update: object, coroutine: Awaitable):
+        if self.pending >= self.max_pending:
+            self.shed += 1
+            coroutine.close()
+            custom_logger.warning('Update shed', extra={
+                'update_id': getattr(update, 'update_id', None),
+                'pending_updates': self.pending,
+                'shed_updates': self.shed,
+            })
+            return
+
+        self.pending += 1
+        try:
+            async with self.slots:
+                async with trace_update(update):
+                    await coroutine
+        finally:
+            self.pending -= 1
 
 
 class TgUpdater:
 
-    def __init__(self, token: str):
+    def __init__(self, token: str, serverless: bool = False, request: BaseRequest | None = None):
+        """request replaces HTTP transport of bot api calls, e.g. with a fake one in benchmarks"""
         if not token:
             raise Exception('Missing bot token!')
-        application = ApplicationBuilder().token(token).build()
+        builder = ApplicationBuilder().token(token)
+        # pool size of the default bot api transport, which is replaced to trace calls
+        builder = builder.request(TracedRequest(request or HTTPXRequest(connection_pool_size=256)))
+        if BOT_API_URL:
+            builder = builder.base_url(f'{BOT_API_URL}/bot').base_file_url(f'{BOT_API_URL}/file/bot')
+        if not serverless:
+            # long-running process handles updates concurrently, bounded so a burst cannot exhaust db pool
+            self.update_processor = BoundedUpdateProcessor(MAX_CONCURRENT_UPDATES, MAX_UPDATE_BACKLOG)
+            builder = builder.concurrent_updates(self.update_processor)
+        application = builder.build()
 
-        application.add_handlers(HANDLERS)
+        # handlers are blocking, so an update holds its slot of the processor until callback finishes
+        # and serverless invocation does not return before callbacks finish
+        application.add_handlers(build_handlers(block=True))
         application.add_error_handler(error_handler)
+        if serverless:
+            # drained by cloud_run only, so a long-running process would collect failed updates forever
+            application.add_error_handler(self._record_failure)
         self.application = application
-        self.bot = Bot(token=token)
+        self.failures: set[int] = set()
+        # update ids taken by this instance, warm container acknowledges redeliveries without a database round trip
+        self.processed = TTLCache(DEDUP_CACHE_SIZE, DEDUP_TTL)
+        # single bot instance, so its identity is fetched by getMe only once per initialization
+        self.bot = application.bot
+        self.initialized = False
 
-    def local_run(self):
-        self.application.run_polling()
+    def local_run(self, mode: str = RUN_MODE):
+        self.application.post_init = self._post_init
+        self.application.job_queue.run_repeating(self._timers_job, interval=TIMER_INTERVAL)
 
-    async def cloud_run(self, event):
-        try:
-            body = json.loads(event['body'])
-            update = Update.de_json(body, self.bot)
-            await self.bot.initialize()
+        if mode == 'webhook':
+            if not WEBHOOK_URL:
+                raise Exception('Missing webhook url!')
+            self.application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=urlparse(WEBHOOK_URL).path.lstrip('/'),
+                webhook_url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+            )
+        else:
+            self.application.run_polling()
+
+    async def initialize(self):
+        if not self.initialized:
             await self.application.initialize()
+            self.initialized = True
+
+    async def shutdown(self):
+        if self.initialized:
+            await self.application.shutdown()
+            self.initialized = False
+
+    async def cloud_run(self, event, keep_alive: bool = False) -> str | list[dict]:
+        """
+        Processes updates of a webhook or message queue event.
+        Updates of different chats are processed concurrently, updates of the same chat in order of arrival.
+        keep_alive leaves application initialized, so warm invocations only pay for process_update
+        :return: Success or Failure for a single update, result of every update for a batch
+        """
+        try:
+            updates, batch = self._unpack(event)
+            await self.initialize()
 
-            async with self.application:
-                await self.application.start()
-                await self.application.process_update(update)
-                await self.application.stop()
+            by_chat: dict[int | None, list[Update]] = defaultdict(list)
+            for update in filter(None, updates):
+                by_chat[update.effective_chat.id if update.effective_chat else None].append(update)
 
-            return 'Success'
+            failed = set()
+            # chats of a batch share the bound of a long-running process, each one holds a session meanwhile
+            slots = asyncio.Semaphore(MAX_CONCURRENT_UPDATES)
+            await asyncio.gather(*(
+                self._process_chat(chat_updates, failed, slots) for chat_updates in by_chat.values()
+            ))
+            await outbox.join()
+            custom_logger.debug('Outbox state', extra=outbox.metrics())
+            # pool is loaded only once an update touched the database
+            if pool := sys.modules.get('pool'):
+                custom_logger.debug('Pool state', extra=pool.pool_metrics.as_dict())
+
+            results = [
+                {
+                    'update_id': update.update_id if update else None,
+                    'result': 'Success' if update and update.update_id not in failed else 'Failure',
+                }
+                for update in updates
+            ]
+            if batch:
+                return results
+            return results[0]['result']
         except Exception as exc:
             custom_logger.error('Failed to process update with %s', exc)
-        return 'Failure'
\ No newline at end of file
+        finally:
+            if not keep_alive:
+                await self.shutdown()
+        return 'Failure'
+
+    async def run_timers(self, keep_alive: bool = False) -> int:
+        """
+        Delivers due timers and purges expired processed updates, meant for a periodic trigger of a serverless function.
+        :return: number of delivered timers
+        """
+        try:
+            await self.initialize()
+            delivered = await deliver_due_timers(self.bot)
+            purged = await purge_processed_updates()
+            custom_logger.debug('Timers delivered', extra={'delivered_timers': delivered, 'purged_updates': purged})
+            return delivered
+        finally:
+            if not keep_alive:
+                await self.shutdown()
+
+    @staticmethod
+    async def _post_init(application):
+        if hasattr(signal, 'SIGUSR1'):
+            # kill -USR1 <pid> logs latency histograms, outbox and pool state of the process.
+            # handler runs in the event loop, a plain signal handler could interrupt logging holding its queue lock
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, log_histograms)
+
+    @staticmethod
+    async def _timers_job(context: ContextTypes.DEFAULT_TYPE):
+        await deliver_due_timers(context.bot)
+        await purge_processed_updates()
+
+    def _unpack(self, event) -> tuple[list[Update | None], bool]:
+        """
+        Updates of an event, None for those that could not be parsed.
+        Webhook event carries an update or a json array of updates in its body,
+        message queue trigger event carries an update in the body of every message.
+        :return: updates and whether event is a batch
+        """
+        if 'messages' in event:
+            bodies = [message['details']['message']['body'] for message in event['messages']]
+            return [self._parse(body) for body in bodies], True
+
+        body = json.loads(event['body'])
+        if isinstance(body, list):
+            return [self._parse(item) for item in body], True
+
+        return [Update.de_json(body, self.bot)], False
+
+    def _parse(self, body: str | dict) -> Update | None:
+        try:
+            return Update.de_json(json.loads(body) if isinstance(body, str) else body, self.bot)
+        except Exception as exc:
+            custom_logger.error('Failed to parse update with %s', exc)
+            return None
+
+    async def _process_chat(self, updates: list[Update], failed: set[int], slots: asyncio.Semaphore):
+        async with slots:
+            for update in updates:
+                if update.update_id in self.processed:
+                    custom_logger.info('Duplicate update', extra={'update_id': update.update_id})
+                    continue
+                self.processed.set(update.update_id, True)
+
+                self.failures.discard(update.update_id)
+                try:
+                    async with trace_update(update):
+                        await self.application.process_update(update)
+                except Exception as exc:
+                    custom_logger.error('Failed to process update %s with %s', update.update_id, exc)
+                    failed.add(update.update_id)
+
+                if update.update_id in self.failures:
+                    self.failures.discard(update.update_id)
+                    failed.add(update.update_id)
+
+                # failed update is processed again when redelivered
+                if update.update_id in failed:
+                    self.processed.pop(update.update_id)
+
+    async def _record_failure(self, update: object, context: ContextTypes.DEFAULT_TYPE):
+        """errors of blocking handlers are not raised by process_update, they only reach error handlers"""
+        if isinstance(update, Update):
+            self.failures.add(update.update_id)
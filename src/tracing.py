@@ -0,0 +1,202 @@
+"""
+Per-update tracing of the hot path: handlers, DataStorage methods, SQL statements and bot api calls.
+Spans are aggregated into the trace of the current update and into process-wide histograms,
+a trace is logged as one structured record for sampled and slow updates
+"""
+import random
+import sys
+from bisect import bisect_left
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import wraps
+from inspect import iscoroutinefunction
+from time import perf_counter
+
+from telegram.request import BaseRequest, RequestData
+
+from conf import TRACE_SAMPLE_RATE, TRACE_SLOW_MS
+from logs import custom_logger
+
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class Histogram:
+    """latencies in fixed buckets, quantiles are upper bounds of their buckets"""
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, ms: float):
+        self.counts[bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def quantile(self, q: float) -> float:
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+
+        return self.max
+
+    def as_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else 0.0,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'max': self.max,
+        }
+
+
+class Trace:
+    """spans of one update, name -> [count, total ms]"""
+
+    __slots__ = ('update_id', 'chat_id', 'command', 'spans')
+
+    def __init__(self, update_id: int | None, chat_id: int | None, command: str):
+        self.update_id = update_id
+        self.chat_id = chat_id
+        self.command = command
+        self.spans: dict[str, list] = {}
+
+    def add(self, name: str, ms: float):
+        if (span := self.spans.get(name)) is None:
+            self.spans[name] = [1, ms]
+        else:
+            span[0] += 1
+            span[1] += ms
+
+    def as_record(self, ms: float) -> dict:
+        return {
+            'update_id': self.update_id,
+            'chat_id': self.chat_id,
+            'command': self.command,
+            'duration_ms': round(ms, 3),
+            'spans': {name: {'count': count, 'ms': round(total, 3)} for name, (count, total) in self.spans.items()},
+        }
+
+
+# name -> histogram of the process
+histograms: dict[str, Histogram] = {}
+current_trace: ContextVar[Trace | None] = ContextVar('current_trace', default=None)
+
+
+def record(name: str, ms: float):
+    if (histogram := histograms.get(name)) is None:
+        histogram = histograms[name] = Histogram()
+    histogram.observe(ms)
+
+    if trace := current_trace.get():
+        trace.add(name, ms)
+
+
+def dump() -> dict[str, dict]:
+    return {name: histogram.as_dict() for name, histogram in sorted(histograms.items())}
+
+
+def log_histograms():
+    """latency histograms along with outbox and pool state, which size a long-running process"""
+    custom_logger.info('Trace histograms', extra={'histograms': dump()})
+
+    # neither is imported here, pool is loaded only once an update touched the database
+    if outbox := sys.modules.get('outbox'):
+        custom_logger.info('Outbox state', extra=outbox.outbox.metrics())
+    if pool := sys.modules.get('pool'):
+        custom_logger.info('Pool state', extra=pool.pool_metrics.as_dict())
+
+
+@asynccontextmanager
+async def trace_update(update: object):
+    """binds a trace to the update being processed, tasks spawned meanwhile add to it as well"""
+    message = getattr(update, 'effective_message', None)
+    chat = getattr(update, 'effective_chat', None)
+    text = message.text if message and message.text else ''
+    command = text.split(maxsplit=1)[0].partition('@')[0] if text.startswith('/') else 'other'
+
+    trace = Trace(getattr(update, 'update_id', None), chat.id if chat else None, command)
+    token = current_trace.set(trace)
+    started = perf_counter()
+
+    try:
+        yield trace
+    finally:
+        ms = (perf_counter() - started) * 1000
+        current_trace.reset(token)
+        record(f'update {command}', ms)
+
+        if ms >= TRACE_SLOW_MS or random.random() < TRACE_SAMPLE_RATE:
+            custom_logger.info('Update trace', extra=trace.as_record(ms))
+
+
+def traced(name: str):
+    """records duration of a coroutine function as a span"""
+    def decorator(func):
+        @wraps(func)
+        async def decorated(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                record(name, (perf_counter() - started) * 1000)
+
+        return decorated
+
+    return decorator
+
+
+def trace_methods(cls):
+    """class decorator tracing every public coroutine method"""
+    for name, attr in list(vars(cls).items()):
+        if not name.startswith('_') and iscoroutinefunction(attr):
+            setattr(cls, name, traced(f'{cls.__name__}.{name}')(attr))
+
+    return cls
+
+
+def instrument_engine(engine):
+    """records every SQL statement of the sync engine behind an async one, span is named after its verb"""
+    from sqlalchemy import event
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        # execution context lives as long as the statement, so failed ones leave nothing behind
+        context.trace_started = perf_counter()
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        record(f'sql {statement.split(None, 1)[0].upper()}', (perf_counter() - context.trace_started) * 1000)
+
+    event.listen(engine, 'before_cursor_execute', before)
+    event.listen(engine, 'after_cursor_execute', after)
+
+
+class TracedRequest(BaseRequest):
+    """bot api transport recording every call as a span named after the api method"""
+
+    def __init__(self, request: BaseRequest):
+        self.request = request
+
+    @property
+    def read_timeout(self) -> float | None:
+        return self.request.read_timeout
+
+    async def initialize(self):
+        await self.request.initialize()
+
+    async def shutdown(self):
+        await self.request.shutdown()
+
+    async def do_request(self, url: str, method: str, request_data: RequestData | None = None, *args, **kwargs):
+        started = perf_counter()
+        try:
+            return await self.request.do_request(url, method, request_data, *args, **kwargs)
+        finally:
+            record(f'telegram {url.rsplit("/", 1)[-1]}', (perf_counter() - started) * 1000)
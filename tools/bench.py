@@ -0,0 +1,180 @@
+"""
+Measures latency of every command handled by the bot against a seeded local database.
+Synthetic updates go through TgUpdater.cloud_run of a warm container, bot api is faked in process,
+so results only reflect the bot itself: its code, its queries and its database round trips
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+from pathlib import Path
+from time import perf_counter, time
+
+# outbox limits model telegram and would dominate the measurement
+os.environ.setdefault('OUTBOX_GLOBAL_RATE', '1000000')
+os.environ.setdefault('OUTBOX_CHAT_RATE', '1000000')
+
+from seed import seed, add_arguments, chat_id, student, student_id, teacher, teacher_id
+from fake_telegram import FakeTelegram, FakeRequest, command_update
+
+from sqlalchemy import event
+from telegram.ext import CommandHandler
+
+from db import get_engine
+from handlers import HANDLERS
+from tg import TgUpdater
+
+PRESENT = 5
+# command text and sender of each scenario step, in order, for the n-th course with given students
+SCENARIO = (
+    ('help', lambda c, s: ('/help', teacher_id(c), teacher(c))),
+    ('start', lambda c, s: ('/start', teacher_id(c), teacher(c))),
+    ('stop', lambda c, s: ('/stop', teacher_id(c), teacher(c))),
+    ('lesson', lambda c, s: ('/lesson Benchmark', teacher_id(c), teacher(c))),
+    ('present', lambda c, s: (
+        f'/present {" ".join(student(c, n) for n in range(1, PRESENT + 1))}', teacher_id(c), teacher(c)
+    )),
+    ('grade', lambda c, s: (
+        f'/grade 7 {" ".join(student(c, n) for n in range(1, PRESENT + 1))}', teacher_id(c), teacher(c)
+    )),
+    ('grade+', lambda c, s: (f'/grade + {student(c, 1)}', teacher_id(c), teacher(c))),
+    ('random', lambda c, s: ('/random', teacher_id(c), teacher(c))),
+    ('ignore', lambda c, s: (f'/ignore {student(c, s)}', teacher_id(c), teacher(c))),
+    ('register', lambda c, s: ('/register', student_id(c, s), student(c, s))),
+    ('timer', lambda c, s: ('/timer 5', teacher_id(c), teacher(c))),
+    ('stats', lambda c, s: ('/stats', teacher_id(c), teacher(c))),
+    ('final', lambda c, s: ('/final', teacher_id(c), teacher(c))),
+    ('unknown', lambda c, s: ('/unknown', teacher_id(c), teacher(c))),
+)
+
+
+def check_coverage():
+    """every registered command needs a scenario step, so new commands are not left out silently"""
+    steps = {name.rstrip('+') for name, _ in SCENARIO}
+    commands = {command for handler in HANDLERS if isinstance(handler, CommandHandler) for command in handler.commands}
+
+    if missing := commands - steps:
+        raise SystemExit(f'No benchmark scenario for: {", ".join(sorted(missing))}')
+
+
+def percentile(values: list[float], percent: int) -> float:
+    if len(values) < 2:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[percent - 1]
+
+
+async def run(courses: int, students: int, iterations: int, warmup: int) -> dict[str, dict]:
+    fake = FakeTelegram()
+    updater = TgUpdater('1:fake', serverless=True, request=FakeRequest(fake))
+
+    statements = 0
+
+    def count(*args):
+        nonlocal statements
+        statements += 1
+
+    event.listen(get_engine().sync_engine, 'before_cursor_execute', count)
+
+    samples = {name: {'latency': [], 'statements': [], 'telegram_calls': []} for name, _ in SCENARIO}
+    # processed update ids stay in the database, so every run starts with ids not seen before
+    update_id = int(time() * 1000)
+
+    for iteration in range(warmup + iterations):
+        # every iteration runs in another chat, so per chat rosters and rate limits are not reused
+        course = iteration % courses + 1
+
+        for name, step in SCENARIO:
+            update_id += 1
+            text, user_id, username = step(course, students)
+            update = command_update(
+                update_id, text, chat_id(course), user_id, username, chat_title=f'G{course} Course {course}'
+            )
+            statements_before, calls_before = statements, len(fake.calls)
+
+            started = perf_counter()
+            result = await updater.cloud_run({'body': json.dumps(update)}, keep_alive=True)
+            elapsed = perf_counter() - started
+
+            if result != 'Success':
+                print(f'{name} failed in course {course}', file=sys.stderr)
+            if iteration >= warmup:
+                samples[name]['latency'].append(elapsed * 1000)
+                samples[name]['statements'].append(statements - statements_before)
+                samples[name]['telegram_calls'].append(len(fake.calls) - calls_before)
+
+    await updater.shutdown()
+    event.remove(get_engine().sync_engine, 'before_cursor_execute', count)
+    await get_engine().dispose()
+
+    return {
+        name: {
+            'p50': percentile(sample['latency'], 50),
+            'p95': percentile(sample['latency'], 95),
+            'p99': percentile(sample['latency'], 99),
+            'statements': max(sample['statements']),
+            'telegram_calls': max(sample['telegram_calls']),
+        }
+        for name, sample in samples.items()
+    }
+
+
+def report(results: dict[str, dict], baseline: dict[str, dict] | None, tolerance: float) -> int:
+    """prints results next to baseline, :return: number of regressions"""
+    regressions = 0
+    print(f'{"command":<10} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"queries":>8} {"api calls":>10}')
+
+    for name, result in results.items():
+        line = (
+            f'{name:<10} {result["p50"]:9.2f} {result["p95"]:9.2f} {result["p99"]:9.2f} '
+            f'{result["statements"]:8} {result["telegram_calls"]:10}'
+        )
+
+        if baseline and (previous := baseline.get(name)):
+            change = (result['p95'] - previous['p95']) / previous['p95'] * 100 if previous['p95'] else 0.0
+            line += f'  p95 {change:+.0f}%'
+
+            worse = []
+            if change > tolerance:
+                worse.append('p95')
+            for counter in ('statements', 'telegram_calls'):
+                if result[counter] > previous[counter]:
+                    worse.append(f'{counter} {previous[counter]} -> {result[counter]}')
+            if worse:
+                regressions += 1
+                line += f'  REGRESSION {", ".join(worse)}'
+
+        print(line)
+
+    return regressions
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--seed', action='store_true', help='(re)seed the database before the benchmark')
+    add_arguments(parser, courses=20, students=40, lessons=30)
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--save', type=Path, help='write results as a baseline')
+    parser.add_argument('--compare', type=Path, help='baseline to compare with, fails on regressions')
+    parser.add_argument('--tolerance', type=float, default=20, help='allowed p95 growth in percent')
+    args = parser.parse_args()
+
+    check_coverage()
+
+    if args.seed:
+        await seed(args.courses, args.students, args.lessons, database=args.database)
+
+    results = await run(args.courses, args.students, args.iterations, args.warmup)
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+    regressions = report(results, baseline, args.tolerance)
+
+    if args.save:
+        args.save.write_text(json.dumps(results, indent=2))
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,106 @@
+"""
+Measures cold start of the serverless function in the build.zip layout produced by `make build`.
+Every run is a fresh interpreter without bytecode cache that imports index from the extracted archive
+and handles a single update against a local fake bot api, commands that don't touch the database need no database.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import zipfile
+from pathlib import Path
+from time import perf_counter
+
+from fake_telegram import FakeTelegram, command_update
+
+ROOT = Path(__file__).resolve().parent.parent
+# modules a cold start should not load unless the update touches the database
+HEAVY_MODULES = ('sqlalchemy', 'sqlalchemy.orm', 'asyncpg', 'db', 'data')
+
+PROBE = f"""
+import asyncio, json, sys, time
+started = time.perf_counter()
+import index
+imported = time.perf_counter()
+response = asyncio.run(index.handler({{'body': sys.argv[1]}}, None))
+responded = time.perf_counter()
+print(json.dumps({{
+    'import': imported - started,
+    'first_response': responded - imported,
+    'result': response['body'],
+    'loaded': [name for name in {HEAVY_MODULES!r} if name in sys.modules],
+}}))
+"""
+
+
+def run(directory: str, env: dict, update: dict, importtime: bool = False) -> dict:
+    args = [sys.executable, '-B', *(('-X', 'importtime') if importtime else ()), '-c', PROBE, json.dumps(update)]
+
+    started = perf_counter()
+    completed = subprocess.run(args, cwd=directory, env=env, capture_output=True, text=True, check=True)
+    measurement = json.loads(completed.stdout.strip().splitlines()[-1])
+    measurement['process'] = perf_counter() - started
+    measurement['stderr'] = completed.stderr
+
+    return measurement
+
+
+def slowest_imports(stderr: str, top: int) -> list[tuple[int, str]]:
+    """cumulative microseconds of top-level imports reported by -X importtime"""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.removeprefix('import time:').split('|')
+        if not name.startswith('  '):
+            imports.append((int(cumulative), name.strip()))
+
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--zip', type=Path, default=ROOT / 'build.zip')
+    parser.add_argument('--build', action='store_true', help='run make build first')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--command', action='append', help='command to send, /help and /stop by default')
+    parser.add_argument('--profile', type=int, default=0, metavar='N', help='print N slowest imports')
+    args = parser.parse_args()
+
+    if args.build:
+        subprocess.run(['make', 'clean', 'build'], cwd=ROOT, check=True)
+
+    fake = FakeTelegram()
+    env = {
+        **os.environ,
+        'BOT_TOKEN': '1:fake',
+        'BOT_API_URL': fake.serve(),
+        'WARM_START': '0',
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        with zipfile.ZipFile(args.zip) as archive:
+            archive.extractall(directory)
+
+        for number, command in enumerate(args.command or ['/help', '/stop'], start=1):
+            update = command_update(number, command, chat_id=-1000001, user_id=1001, username='teacher_1')
+            runs = [run(directory, env, update) for _ in range(args.runs)]
+
+            print(f'{command}: {runs[0]["result"]}, loaded {", ".join(runs[0]["loaded"]) or "no database modules"}')
+            for phase in ('import', 'first_response', 'process'):
+                values = [measurement[phase] * 1000 for measurement in runs]
+                print(f'  {phase:<15} median {statistics.median(values):8.1f} ms  max {max(values):8.1f} ms')
+
+            if args.profile:
+                profiled = run(directory, env, update, importtime=True)
+                for cumulative, name in slowest_imports(profiled['stderr'], args.profile):
+                    print(f'  {cumulative / 1000:8.1f} ms  {name}')
+
+    fake.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Runs every DataStorage query against a seeded database, EXPLAINs it
+and fails if the plan falls back to a sequential scan of a large table
+"""
+import argparse
+import asyncio
+import json
+import sys
+from datetime import date, datetime, timezone
+
+from seed import seed, add_arguments, chat_id, student, student_id, teacher_id
+
+from sqlalchemy import event, text
+
+from data import (
+    DataStorage, UserInfo, rosters, roles, claim_due_timers, remove_timers, get_year_final_inputs
+)
+from db import ASession, get_engine
+
+# tables smaller than that are cheaper to scan, so planner is right to do it
+LARGE_TABLE_ROWS = 5000
+
+
+async def exercise(statements: list[tuple[str, tuple]]):
+    """runs DataStorage methods and data layer functions in a transaction rolled back afterwards, year export aside"""
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            statements.append((statement, parameters))
+
+    rosters.clear()
+    roles.clear()
+    event.listen(get_engine().sync_engine, 'before_cursor_execute', record)
+
+    try:
+        async with ASession() as session:
+            ds = DataStorage(chat_id(1), session)
+            students = {student(1, number) for number in range(1, 6)}
+
+            await ds.claim_update(1)
+            await ds.get_course()
+            await ds.check_is_teacher(f'{teacher_id(1)}')
+            await ds.resolve_names(students)
+            await ds.get_current_lesson()
+            await ds.get_lesson_candidates()
+            await ds.get_presented()
+            await ds.mark_present(students)
+            await ds.grade_students(students, 7)
+            await ds.grade_students(students, '+')
+            await ds.get_attendance()
+            await ds.get_performance(fetch_grades=True)
+            await ds.get_performance(fetch_grades=False)
+            await ds.get_stats()
+            await ds.get_stats(students)
+            await ds.get_lessons()
+            async for _ in ds.stream_gradebook():
+                pass
+            await ds.get_final_inputs()
+            await ds.add_timer(datetime.now(timezone.utc), 'explain')
+            await ds.remove_student(student(1, 1))
+            await ds.add_student(UserInfo(f'{student_id(1, 1)}', student(1, 1), 'Student 1 1'))
+            await ds.start_lesson('explain', date.today())
+            await ds.set_summary_message(1)
+            await ds.rebuild_stats()
+
+            await remove_timers(session, [timer.id for timer in await claim_due_timers(session, 100)])
+
+            await session.rollback()
+
+        await get_year_final_inputs(date.today().year)
+    finally:
+        event.remove(get_engine().sync_engine, 'before_cursor_execute', record)
+
+
+def sequential_scans(plan: dict, large_tables: set[str]) -> list[str]:
+    found = []
+
+    if plan.get('Node Type') == 'Seq Scan' and plan.get('Relation Name') in large_tables:
+        found.append(plan['Relation Name'])
+
+    for child in plan.get('Plans', ()):
+        found.extend(sequential_scans(child, large_tables))
+
+    return found
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--seed', action='store_true', help='(re)seed the database before the check')
+    add_arguments(parser, courses=200, students=50, lessons=40)
+    args = parser.parse_args()
+
+    if args.seed:
+        await seed(args.courses, args.students, args.lessons, database=args.database)
+
+    statements: list[tuple[str, tuple]] = []
+    await exercise(statements)
+
+    failures = 0
+
+    async with get_engine().connect() as conn:
+        result = await conn.execute(
+            text("SELECT relname FROM pg_class WHERE relkind = 'r' AND reltuples > :rows"),
+            {'rows': LARGE_TABLE_ROWS}
+        )
+        large_tables = set(result.scalars())
+
+        for statement, parameters in statements:
+            if not statement.lstrip().upper().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')):
+                continue
+
+            result = await conn.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {statement}', parameters)
+            plan = result.scalar()
+            plan = json.loads(plan) if isinstance(plan, str) else plan
+
+            if scanned := sequential_scans(plan[0]['Plan'], large_tables):
+                failures += 1
+                print(f'FAIL seq scan on {", ".join(scanned)}:\n{statement}\n')
+            else:
+                print(f'ok   {" ".join(statement.split())[:100]}')
+
+        await conn.rollback()
+
+    await get_engine().dispose()
+    print(f'{len(statements)} statements, {failures} with sequential scans of {sorted(large_tables)}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,124 @@
+"""
+Local stand-in for the bot api, answers every method successfully and records calls.
+Point a separate process to it with BOT_API_URL, see cold_start.py,
+or pass FakeRequest to TgUpdater to skip HTTP altogether, see bench.py
+"""
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from threading import Thread
+from time import time
+from urllib.parse import parse_qsl
+
+from telegram.request import BaseRequest, RequestData
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Assistant', 'username': 'assistant_bot', 'can_join_groups': True}
+MESSAGE_METHODS = {'sendMessage', 'editMessageText', 'sendDocument'}
+
+
+class FakeTelegram:
+
+    def __init__(self):
+        self.calls: list[tuple[str, dict]] = []
+        self._message_ids = count(1)
+        self._server: ThreadingHTTPServer | None = None
+
+    def answer(self, method: str, params: dict):
+        self.calls.append((method, params))
+
+        if method == 'getMe':
+            return BOT_USER
+        if method in MESSAGE_METHODS:
+            return {
+                'message_id': int(params.get('message_id') or next(self._message_ids)),
+                'date': int(time()),
+                'chat': {'id': int(params.get('chat_id', 0)), 'type': 'supergroup'},
+                'text': params.get('text', ''),
+            }
+        if method == 'exportChatInviteLink':
+            return 'https://t.me/+fake'
+
+        return True
+
+    def serve(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """starts the server in a background thread, :return: url for BOT_API_URL"""
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                # path is /bot<token>/<method>
+                method = self.path.rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                    params = dict(parse_qsl(body.decode()))
+                else:
+                    # multipart uploads are only counted
+                    params = {'size': len(body)}
+
+                payload = json.dumps({'ok': True, 'result': fake.answer(method, params)}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', f'{len(payload)}')
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        Thread(target=self._server.serve_forever, daemon=True).start()
+
+        return f'http://{host}:{self._server.server_port}'
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+class FakeRequest(BaseRequest):
+    """bot api transport answering from FakeTelegram in process"""
+
+    def __init__(self, fake: FakeTelegram):
+        self.fake = fake
+
+    @property
+    def read_timeout(self) -> float | None:
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: RequestData | None = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None,
+                         pool_timeout=None) -> tuple[int, bytes]:
+        if request_data is None:
+            params = {}
+        elif request_data.contains_files:
+            params = {'size': len(request_data.multipart_data)}
+        else:
+            params = request_data.json_parameters
+
+        result = self.fake.answer(url.rsplit('/', 1)[-1], params)
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+def command_update(update_id: int, text: str, chat_id: int, user_id: int, username: str,
+                   chat_title: str = 'G1 Course') -> dict:
+    """update of a group message with a command, as telegram posts it to a webhook"""
+    command = text.split()[0]
+
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time()),
+            'chat': {'id': chat_id, 'type': 'supergroup', 'title': chat_title},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': username, 'username': username},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+        },
+    }
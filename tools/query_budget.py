@@ -0,0 +1,205 @@
+"""
+Counts SQL statements of every DataStorage method and every command at several roster sizes.
+Fails if a count grows with the roster, which is how N+1 queries show up, or exceeds its declared budget.
+NB: reseeds the database for every size, so it has to be named with --database
+"""
+import argparse
+import asyncio
+import json
+import sys
+from datetime import date, datetime, timezone
+
+from bench import SCENARIO, check_coverage
+from seed import seed, chat_id, student, student_id, teacher_id
+from fake_telegram import FakeTelegram, FakeRequest, command_update
+
+from sqlalchemy import event
+
+from data import DataStorage, UserInfo, rosters, roles
+from db import ASession, get_engine
+from tg import TgUpdater
+
+# statements of a call made with cold caches, flush included
+METHOD_BUDGETS = {
+    'claim_update': 1,
+    'get_course': 1,
+    'check_is_teacher': 1,
+    'start_lesson': 3,
+    'set_summary_message': 1,
+    'get_current_lesson': 1,
+    'mark_present': 1,
+    'grade': 1,
+    'participation': 1,
+    'get_lesson_candidates': 1,
+    'get_presented': 1,
+    'get_attendance': 1,
+    'get_grades': 1,
+    'get_participation': 1,
+    'get_stats': 1,
+    'get_changed_stats': 1,
+    'remove_student': 4,
+    'add_student': 4,
+    'add_timer': 1,
+    'export_gradebook': 2,
+    'get_final_inputs': 1,
+    'resolve_names': 1,
+    'rebuild_stats': 2,
+}
+
+# statements of a whole update, caches are cold as in a fresh container
+COMMAND_BUDGETS = {
+    'help': 0,
+    'start': 2,
+    'stop': 0,
+    'lesson': 5,
+    'present': 5,
+    'grade': 5,
+    'grade+': 5,
+    'random': 2,
+    'ignore': 5,
+    'register': 5,
+    'timer': 2,
+    'stats': 4,
+    'final': 3,
+    'unknown': 0,
+}
+
+
+class StatementCounter:
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+    async def measure(self, coroutine) -> int:
+        rosters.clear()
+        roles.clear()
+        before = self.count
+        await coroutine
+
+        return self.count - before
+
+
+async def export_gradebook(ds: DataStorage):
+    await ds.get_lessons()
+    async for _ in ds.stream_gradebook():
+        pass
+
+
+async def count_methods(counter: StatementCounter, students: int) -> dict[str, int]:
+    """calls every public DataStorage method of the first course in one transaction, rolled back afterwards"""
+    everyone = {student(1, number) for number in range(1, students + 1)}
+    changed = {student(1, number) for number in range(1, min(students, 5) + 1)}
+
+    calls = (
+        ('claim_update', lambda ds: ds.claim_update(1)),
+        ('get_course', lambda ds: ds.get_course()),
+        ('check_is_teacher', lambda ds: ds.check_is_teacher(f'{teacher_id(1)}')),
+        ('start_lesson', lambda ds: ds.start_lesson('budget', date.today())),
+        ('set_summary_message', lambda ds: ds.set_summary_message(1)),
+        ('get_current_lesson', lambda ds: ds.get_current_lesson()),
+        ('mark_present', lambda ds: ds.mark_present(everyone)),
+        ('grade', lambda ds: ds.grade_students(everyone, 7)),
+        ('participation', lambda ds: ds.grade_students(everyone, '+')),
+        ('get_lesson_candidates', lambda ds: ds.get_lesson_candidates()),
+        ('get_presented', lambda ds: ds.get_presented()),
+        ('get_attendance', lambda ds: ds.get_attendance()),
+        ('get_grades', lambda ds: ds.get_performance(fetch_grades=True)),
+        ('get_participation', lambda ds: ds.get_performance(fetch_grades=False)),
+        ('get_stats', lambda ds: ds.get_stats()),
+        ('get_changed_stats', lambda ds: ds.get_stats(changed)),
+        ('remove_student', lambda ds: ds.remove_student(student(1, 1))),
+        ('add_student', lambda ds: ds.add_student(UserInfo(f'{student_id(1, 1)}', student(1, 1), 'Student 1 1'))),
+        ('add_timer', lambda ds: ds.add_timer(datetime.now(timezone.utc), 'budget')),
+        ('export_gradebook', export_gradebook),
+        ('get_final_inputs', lambda ds: ds.get_final_inputs()),
+        ('resolve_names', lambda ds: ds.resolve_names(everyone)),
+        ('rebuild_stats', lambda ds: ds.rebuild_stats()),
+    )
+
+    counts = {}
+    async with ASession() as session:
+        for name, call in calls:
+            # fresh instance, so nothing is memoized between calls
+            ds = DataStorage(chat_id(1), session)
+
+            async def call_and_flush():
+                await call(ds)
+                await session.flush()
+
+            counts[name] = await counter.measure(call_and_flush())
+
+        await session.rollback()
+
+    return counts
+
+
+async def count_commands(counter: StatementCounter, students: int) -> dict[str, int]:
+    """sends every command of the benchmark scenario to the first course"""
+    updater = TgUpdater('1:fake', serverless=True, request=FakeRequest(FakeTelegram()))
+
+    counts = {}
+    for update_id, (name, step) in enumerate(SCENARIO, start=1):
+        text, user_id, username = step(1, students)
+        update = command_update(update_id, text, chat_id(1), user_id, username, chat_title='G1 Course 1')
+        counts[name] = await counter.measure(updater.cloud_run({'body': json.dumps(update)}, keep_alive=True))
+
+    await updater.shutdown()
+
+    return counts
+
+
+def check(kind: str, counts_by_size: dict[int, dict[str, int]], budgets: dict[str, int]) -> int:
+    """prints counts per roster size, :return: number of failures"""
+    sizes = sorted(counts_by_size)
+    failures = 0
+    print(f'{kind:<22} ' + ' '.join(f'{size:>6}' for size in sizes) + '  budget')
+
+    for name in counts_by_size[sizes[0]].keys() - budgets.keys():
+        failures += 1
+        print(f'{name:<22} no budget declared')
+
+    for name, budget in budgets.items():
+        counts = [counts_by_size[size][name] for size in sizes]
+        problems = []
+        if counts[-1] > counts[0]:
+            problems.append('grows with roster')
+        if max(counts) > budget:
+            problems.append('over budget')
+
+        failures += bool(problems)
+        print(f'{name:<22} ' + ' '.join(f'{count:>6}' for count in counts) + f'  {budget:>6}  {", ".join(problems)}')
+
+    return failures
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5, 50, 500], help='students per course')
+    parser.add_argument('--lessons', type=int, default=10)
+    parser.add_argument('--database', required=True, help='name of the dedicated database DB_* point to, it is wiped')
+    args = parser.parse_args()
+
+    check_coverage()
+
+    counter = StatementCounter()
+    methods: dict[int, dict[str, int]] = {}
+    commands: dict[int, dict[str, int]] = {}
+
+    for size in args.sizes:
+        await seed(courses=2, students=size, lessons=args.lessons, database=args.database)
+        event.listen(get_engine().sync_engine, 'before_cursor_execute', counter)
+        methods[size] = await count_methods(counter, size)
+        commands[size] = await count_commands(counter, size)
+        event.remove(get_engine().sync_engine, 'before_cursor_execute', counter)
+
+    failures = check('method', methods, METHOD_BUDGETS) + check('command', commands, COMMAND_BUDGETS)
+
+    await get_engine().dispose()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,127 @@
+"""
+Fills the configured database with synthetic courses for benchmarks and query checks.
+NB: drops and recreates all tables, point DB_* environment variables to a dedicated local database
+and name it with --database, seeding refuses to run otherwise
+"""
+import argparse
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from sqlalchemy import text
+
+from data import backfill
+from db import Base, get_engine
+
+SEED_STATEMENTS = (
+    """
+    INSERT INTO courses (chat_id, title, year, exam_weight, "group")
+    SELECT (-1000000 - c)::text, 'Course ' || c, extract(year FROM current_date)::int, 40, 'G' || c
+    FROM generate_series(1, :courses) c
+    """,
+    """
+    INSERT INTO users (tg_id, username, name)
+    SELECT c::text, 'teacher_' || c, 'Teacher ' || c
+    FROM generate_series(1, :courses) c
+    UNION ALL
+    SELECT (c * 1000000 + s)::text, 'student_' || c || '_' || s, 'Student ' || c || ' ' || s
+    FROM generate_series(1, :courses) c, generate_series(1, :students) s
+    """,
+    """
+    INSERT INTO users_courses (user_id, course_id, teacher)
+    SELECT u.id, co.id, u.username LIKE 'teacher_%'
+    FROM users u
+    JOIN courses co ON co.title = 'Course ' || split_part(u.username, '_', 2)
+    """,
+    """
+    INSERT INTO lessons (title, type, date, course_id)
+    SELECT 'Lesson ' || l, 1, current_date - (:lessons - l), co.id
+    FROM courses co, generate_series(1, :lessons) l
+    ORDER BY co.id, l
+    """,
+    """
+    INSERT INTO attendances (user_id, lesson_id, grade, participation)
+    SELECT uc.user_id, l.id,
+           CASE WHEN random() < 0.3 THEN (random() * 10)::int END,
+           CASE WHEN random() < 0.2 THEN random() < 0.7 END
+    FROM users_courses uc
+    JOIN lessons l ON l.course_id = uc.course_id
+    WHERE NOT uc.teacher AND random() < :attendance_rate
+    """,
+)
+
+
+def chat_id(course: int) -> int:
+    """chat id of the n-th seeded course, counting from 1"""
+    return -1000000 - course
+
+
+def student(course: int, number: int) -> str:
+    """username of the n-th student of the n-th seeded course, counting from 1"""
+    return f'student_{course}_{number}'
+
+
+def student_id(course: int, number: int) -> int:
+    """telegram user id of the n-th student of the n-th seeded course"""
+    return course * 1000000 + number
+
+
+def teacher(course: int) -> str:
+    """username of the seeded course teacher"""
+    return f'teacher_{course}'
+
+
+def teacher_id(course: int) -> int:
+    """telegram user id of the seeded course teacher"""
+    return course
+
+
+def check_database(database: str | None):
+    """seeding wipes the configured database, so its name has to be given explicitly, DB_* default to production"""
+    configured = get_engine().url.database
+    if database != configured:
+        raise SystemExit(
+            f'Refusing to wipe database {configured!r}, point DB_* to a dedicated one and pass --database with its name'
+        )
+
+
+async def seed(courses: int = 10, students: int = 40, lessons: int = 30, attendance_rate: float = 0.8,
+               database: str | None = None):
+    check_database(database)
+    params = {'courses': courses, 'students': students, 'lessons': lessons, 'attendance_rate': attendance_rate}
+
+    async with get_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+
+        for statement in SEED_STATEMENTS:
+            await conn.execute(text(statement), params)
+
+    await backfill()
+
+    async with get_engine().connect() as conn:
+        await conn.execution_options(isolation_level='AUTOCOMMIT')
+        await conn.execute(text('ANALYZE'))
+
+
+def add_arguments(parser: argparse.ArgumentParser, courses: int = 10, students: int = 40, lessons: int = 30):
+    parser.add_argument('--courses', type=int, default=courses)
+    parser.add_argument('--students', type=int, default=students, help='students per course')
+    parser.add_argument('--lessons', type=int, default=lessons, help='lessons per course')
+    parser.add_argument('--database', help='name of the dedicated database DB_* point to, required to (re)seed it')
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    parser.add_argument('--attendance-rate', type=float, default=0.8)
+    args = parser.parse_args()
+
+    await seed(args.courses, args.students, args.lessons, args.attendance_rate, database=args.database)
+    await get_engine().dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())